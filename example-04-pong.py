@@ -132,8 +132,6 @@ def main():
         score=(0, 0),
     )
 
-    key_pressed = {}
-
     while gamelib.loop():
         gamelib.draw_begin()
         draw_paddle(state, PADDLE1)
@@ -142,16 +140,14 @@ def main():
         draw_score(state)
         gamelib.draw_end()
 
-        for event in gamelib.get_events():
-            if event.type == gamelib.EventType.KeyPress:
-                key_pressed[event.key] = True
-            if event.type == gamelib.EventType.KeyRelease:
-                key_pressed[event.key] = False
+        # the paddles are moved by polling the keyboard, but the events still
+        # have to be taken from the queue
+        gamelib.get_events()
 
-        if key_pressed.get('q', False):    state = move_paddle(state, PADDLE1, -1)
-        if key_pressed.get('a', False):    state = move_paddle(state, PADDLE1, +1)
-        if key_pressed.get('Up', False):   state = move_paddle(state, PADDLE2, -1)
-        if key_pressed.get('Down', False): state = move_paddle(state, PADDLE2, +1)
+        if gamelib.is_key_down('q'):    state = move_paddle(state, PADDLE1, -1)
+        if gamelib.is_key_down('a'):    state = move_paddle(state, PADDLE1, +1)
+        if gamelib.is_key_down('Up'):   state = move_paddle(state, PADDLE2, -1)
+        if gamelib.is_key_down('Down'): state = move_paddle(state, PADDLE2, +1)
 
         state = move_ball(state)
         state = check_goal(state)
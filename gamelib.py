@@ -6,112 +6,512 @@ https://github.com/dessaya/python-gamelib
 """
 
 import tkinter as tk
-from tkinter.font import Font
+from tkinter import font as tkfont
 from tkinter import simpledialog, messagebox
 from queue import Queue, Empty
+from collections import deque, OrderedDict
 from enum import Enum
+from array import array
 import threading
+import warnings
+import wave
+import asyncio
+import inspect
+import itertools
+import math
+import operator
+import gzip
+import pickle
+import random
+import struct
 import time
 import signal
 import os
 import sys
 
-class _TkWindow(tk.Tk):
+class _Window:
+    """
+    Base class for the window backends. The game thread sends commands to the
+    window through the `commands` queue, and the window executes them in its
+    own thread.
+    """
+
     instance = None
     initialized = threading.Event()
     commands = Queue()
 
-    busy_count = 0
-    idle = threading.Event()
-    idle.set()
+    # Whether the window produces user input events.
+    interactive = True
+
+    # Frames sent by the game thread that have not been rendered (or dropped)
+    # yet. With pipeline_depth == 0, draw_begin waits until the previous frame
+    # is rendered; otherwise draw_end only waits when pipeline_depth frames
+    # are in flight.
+    frames_in_flight = 0
+    pipeline_depth = 0
+    frames_cond = threading.Condition()
+
+    # Timing information of the frames drawn by the window, to be reported to
+    # the game thread (see _GameThread.on_frame_stats).
+    frame_infos = deque(maxlen=100)
+
+    @classmethod
+    def frames_done(cls, n=1):
+        with cls.frames_cond:
+            cls.frames_in_flight = max(0, cls.frames_in_flight - n)
+            cls.frames_cond.notify_all()
+        if cls.frames_listener:
+            cls.frames_listener()
+
+    # Function called from the window thread when frames are done, see _AsyncBridge
+    frames_listener = None
+
+    @classmethod
+    def wait_frames_in_flight(cls, limit, reserve=False):
+        with cls.frames_cond:
+            cls.frames_cond.wait_for(lambda: cls.frames_in_flight < limit or cls.is_closed())
+            if reserve:
+                cls.frames_in_flight += 1
+
+    @classmethod
+    def is_closed(cls):
+        w = cls.instance
+        return not w or w.closed
+
+    # Commands that may be included in a frame (see draw_frame)
+    FRAME_COMMANDS = (
+        'clear', 'flush', 'draw', 'draw_text', 'draw_image', 'draw_many', 'draw_points',
+        'draw_framebuffer', 'draw_tile_chunk', 'layer',
+    )
 
     def __init__(self):
         super().__init__()
-
         self.closed = False
+        self.dropped_frames = 0
+        self.frame_methods = {name: getattr(self, name) for name in self.FRAME_COMMANDS}
+
+    def close(self):
+        self.closed = True
+        _Window.frames_done(0)
+
+    def drain_commands(self):
+        commands = []
+        while True:
+            try:
+                commands.append(_Window.commands.get(False))
+            except Empty:
+                return commands
+
+    def run_commands(self, commands):
+        # If rendering fell behind, only the most recent frame is drawn (but
+        # frames that redraw a layer other than the default one are always
+        # drawn, since the layer would not be redrawn otherwise)
+        last_frame = None
+        for i, (method, *_) in enumerate(commands):
+            if method == 'draw_frame':
+                last_frame = i
+
+        dropped = 0
+        for i, (method, *args) in enumerate(commands):
+            if method == 'draw_frame' and i != last_frame and not args[1]['layers']:
+                dropped += 1
+                continue
+            try:
+                getattr(self, method)(*args)
+            except Exception:
+                self.report_callback_exception(*sys.exc_info())
+        if dropped:
+            self.dropped_frames += dropped
+            _Window.frames_done(dropped)
+
+    def draw_frame(self, commands, info):
+        start = time.perf_counter()
+        try:
+            methods = self.frame_methods
+            for method, *args in commands:
+                methods[method](*args)
+        finally:
+            end = time.perf_counter()
+            info['queue_wait'] = start - info.pop('submitted')
+            info['render_time'] = end - start
+            info['items'] = self.item_count()
+            info['dropped'] = self.dropped_frames
+            _Window.frame_infos.append(info)
+            _Window.frames_done()
+
+    def draw_many(self, type, coords, colors, options):
+        options = {'fill': 'white', **options}
+        draw_item = self.draw_item
+        if colors is None:
+            for i in range(0, len(coords), 4):
+                draw_item(type, tuple(coords[i:i + 4]), options)
+        else:
+            for i, color in enumerate(colors):
+                draw_item(type, tuple(coords[i * 4:i * 4 + 4]), {**options, 'fill': color})
+
+    def draw_points(self, size, coords, colors, options):
+        rectangles = []
+        for i in range(0, len(coords), 2):
+            x, y = coords[i], coords[i + 1]
+            rectangles += (x, y, x + size, y + size)
+        self.draw_many('rectangle', rectangles, colors, {'width': 0, **options})
+
+    def with_window(self, func, args):
+        func(self, *args)
+
+class _TkWindow(_Window, tk.Tk):
+    def __init__(self):
+        super().__init__()
 
         self.title("Gamelib")
         self.resizable(False, False)
 
         self.assets = {}
+        self.images = _ImageCache()
+
+        # Canvas items are grouped in layers (see _GameThread.layer). The
+        # default layer is None, and it is redrawn on every frame.
+        self.layers = {}
+        self.sorted_layers = []
+        self.select_layer(None, 0)
+
+        # Sprites, indexed by id; see Sprite
+        self.sprites = {}
+
+        # Canvas item showing the performance overlay, see show_stats
+        self.overlay = None
+        self.overlay_enabled = False
 
         self.canvas = tk.Canvas(background='black')
         self.canvas.grid(column=0, row=0, sticky="nwes")
-
-        for event_type in EventType:
-            self.bind(f"<{event_type.name}>", self.handle_event)
+        # Size of the canvas in pixels, see draw_tilemap
+        self.canvas_size = tuple(round(self.canvas.winfo_fpixels(self.canvas[k])) for k in ('width', 'height'))
+
+        # Whether a <<notify>> event is pending, see notify
+        self.notify_lock = threading.Lock()
+        self.notify_pending = False
+
+        # Event types sent to the game thread, event types needed to keep track
+        # of the input state (see track_input), and event types bound
+        self.subscribed = set(EventType)
+        self.tracked = {EventType.KeyPress, EventType.KeyRelease, EventType.ButtonPress, EventType.ButtonRelease}
+        self.bound = set()
+        self.update_bindings()
         self.bind(f"<<notify>>", self.process_commands)
+        self.bind("<F12>", lambda e: self.show_stats(not self.overlay_enabled))
         self.protocol("WM_DELETE_WINDOW", self.close)
 
         self.canvas.focus_set()
         self.after_idle(self.process_commands)
 
     def close(self):
-        self.closed = True
+        super().close()
         self.quit()
         self.update()
 
     def notify(self):
-        if not self.closed:
-            self.event_generate('<<notify>>', when='tail')
+        # Only generate a <<notify>> event if there isn't one pending already;
+        # process_commands drains all queued commands anyway.
+        with self.notify_lock:
+            if self.notify_pending or self.closed:
+                return
+            self.notify_pending = True
+        self.event_generate('<<notify>>', when='tail')
 
     def process_commands(self, *args):
-        _TkWindow.busy_count += 1
-        _TkWindow.idle.clear()
-        try:
-            while True:
-                try:
-                    method, *args = _TkWindow.commands.get(False)
-                    getattr(self, method)(*args)
-                except Empty:
-                    break
-        finally:
-            _TkWindow.busy_count -= 1
-            if _TkWindow.busy_count == 0:
-                _TkWindow.idle.set()
+        with self.notify_lock:
+            # cleared before draining, so that commands queued from now on
+            # generate a new notification
+            self.notify_pending = False
+        self.run_commands(self.drain_commands())
+
+    def draw_frame(self, commands, info):
+        super().draw_frame(commands, info)
+        if self.overlay_enabled:
+            self.draw_overlay(info)
+
+    def item_count(self):
+        return sum(len(layer.items) for layer in self.layers.values())
+
+    def show_stats(self, show):
+        self.overlay_enabled = show
+        if not show and self.overlay is not None:
+            self.canvas.delete(self.overlay)
+            self.overlay = None
+
+    def draw_overlay(self, info):
+        text = (
+            f"fps {info['fps']:.1f}  frame {info['frame_time'] * 1000:.1f} ms\n"
+            f"build {info['build_time'] * 1000:.1f} ms  commands {info['commands']}\n"
+            f"queue {info['queue_wait'] * 1000:.1f} ms  render {info['render_time'] * 1000:.1f} ms\n"
+            f"items {info['items']}  dropped {info['dropped']}"
+        )
+        if self.overlay is None:
+            self.overlay = self.canvas.create_text(
+                4, 4, anchor='nw', fill='yellow', font='TkFixedFont', text=text,
+            )
+        else:
+            self.canvas.itemconfigure(self.overlay, text=text)
+        self.canvas.tag_raise(self.overlay)
 
     def handle_event(self, tkevent):
-        _GameThread.events.put(Event(tkevent))
+        event = Event.from_tk(tkevent)
+        recording = _GameThread.recorder
+        if not recording and not _GameThread.replayer:
+            # in record and replay mode the input state is updated by the game
+            # thread at frame boundaries, so that replays are deterministic
+            _GameThread.input_state.update(event)
+        if recording or event.type in self.subscribed:
+            _GameThread.events.put(event)
+
+    def subscribe(self, event_types):
+        self.subscribed |= set(event_types)
+        self.update_bindings()
+
+    def unsubscribe(self, event_types):
+        self.subscribed -= set(event_types)
+        self.update_bindings()
+
+    def track_input(self, event_types):
+        self.tracked |= set(event_types)
+        self.update_bindings()
+
+    def update_bindings(self):
+        wanted = self.subscribed | self.tracked
+        for event_type in wanted - self.bound:
+            self.bind(f"<{event_type.name}>", self.handle_event)
+        for event_type in self.bound - wanted:
+            self.unbind(f"<{event_type.name}>")
+        self.bound = wanted
 
     def resize(self, w, h):
         self.canvas.configure(width=w, height=h)
+        self.canvas_size = (w, h)
 
     def clear(self):
-        self.canvas.delete("all")
+        self.images.frame += 1
+        self.select_layer(None, 0)
+
+    def layer(self, name, z):
+        self.select_layer(name, z)
+
+    def select_layer(self, name, z):
+        layer = self.layers.get(name)
+        if layer is None:
+            layer = self.layers[name] = _Layer(z, len(self.layers))
+            self.sorted_layers = sorted(self.layers.values(), key=_Layer.key)
+        elif layer.z != z:
+            layer.z = z
+            self.sorted_layers = sorted(self.layers.values(), key=_Layer.key)
+            below = self.item_below(layer)
+            for item in layer.items:
+                if below:
+                    self.canvas.tag_raise(item[0], below)
+                else:
+                    self.canvas.tag_lower(item[0])
+                below = item[0]
+        if not layer.touched:
+            # first time in this frame: redraw the layer from the start
+            layer.cursor = 0
+            layer.touched = True
+        self.current_layer = layer
+
+    def item_below(self, layer):
+        "Return the topmost item of the layers below `layer`, or None."
+        below = None
+        for other in self.sorted_layers:
+            if other is layer:
+                break
+            if other.items:
+                below = other.items[-1][0]
+        return below
+
+    def flush(self):
+        for layer in self.layers.values():
+            if layer.touched:
+                for item in layer.items[layer.cursor:]:
+                    self.canvas.delete(item[0])
+                del layer.items[layer.cursor:]
+                layer.touched = False
+        self.update_idletasks()
 
     def icon(self, path):
         self.tk.call('wm', 'iconphoto', self._w, self.get_image(path))
 
-    def draw_image(self, path, x, y):
-        self.canvas.create_image(x, y, anchor='nw', image=self.get_image(path))
+    def draw_image(self, path, x, y, frame=None, zoom=1, subsample=1):
+        image = self.images.get(path, frame, zoom, subsample)
+        self.draw_item('image', (x, y), {'anchor': 'nw', 'image': image})
 
     def draw(self, type, args, kwargs):
         options = {'fill': 'white'}
         options.update(kwargs)
-        getattr(self.canvas, f'create_{type}')(*args, **options)
+        self.draw_item(type, tuple(args), options)
 
-    def draw_text(self, text, x, y, font, size, bold, italic, kwargs):
+    def draw_text(self, text, x, y, font, kwargs):
         options = {'fill': 'white'}
         options.update(kwargs)
-        self.canvas.create_text(x, y, text=text, font=self.get_font(font, size, bold, italic), **options)
-
-    def get_font(self, family, size, bold, italic):
-        weight = 'normal'
-        if bold:
-            weight = 'bold'
-        slant = 'roman'
-        if italic:
-            slant = 'italic'
-        name = f'font-{family}-{size}-{weight}-{slant}'
-        if name not in self.assets:
-            self.assets[name] = Font(family=family, size=size, weight=weight, slant=slant)
-        return self.assets[name]
+        options['text'] = text
+        options['font'] = self.get_font(font)
+        self.draw_item('text', (x, y), options)
+
+    def draw_item(self, type, coords, options):
+        """
+        Draw a canvas item, reusing the item at the same position in the
+        previous frame if possible.
+        """
+        layer = self.current_layer
+        items = layer.items
+        i = layer.cursor
+        layer.cursor += 1
+        if i < len(items):
+            item = items[i]
+            item_id, old_type, old_coords, old_options = item
+            if old_type == type and old_options.keys() == options.keys():
+                if old_coords != coords:
+                    self.canvas.coords(item_id, *coords)
+                    item[2] = coords
+                if old_options != options:
+                    changed = {k: v for k, v in options.items() if old_options[k] != v}
+                    self.canvas.itemconfigure(item_id, **changed)
+                    item[3] = options
+                return
+            self.canvas.delete(item_id)
+        item_id = getattr(self.canvas, f'create_{type}')(*coords, **options)
+        if i < len(items) or self.sprites or len(self.layers) > 1:
+            # keep the stacking order: place the new item right above the
+            # previous one in its layer (and below the upper layers and sprites)
+            below = items[i - 1][0] if i > 0 else self.item_below(layer)
+            if below:
+                self.canvas.tag_raise(item_id, below)
+            else:
+                self.canvas.tag_lower(item_id)
+        if i < len(items):
+            items[i] = [item_id, type, coords, options]
+        else:
+            items.append([item_id, type, coords, options])
+
+    def update_sprites(self, updates):
+        for id, changes in updates.items():
+            sprite = self.sprites.get(id)
+            if changes.get('destroy'):
+                if sprite:
+                    self.canvas.delete(sprite['item'])
+                    del self.sprites[id]
+                continue
+            if sprite is None:
+                if 'path' not in changes and 'text' not in changes:
+                    # changes to a sprite that was already destroyed
+                    continue
+                sprite = self.sprites[id] = dict(changes, id=id)
+                state = 'normal' if sprite['visible'] else 'hidden'
+                if 'text' in sprite:
+                    sprite['item'] = self.canvas.create_text(
+                        *sprite['pos'], text=sprite['text'], font=self.get_font(sprite['font']),
+                        state=state, **{'fill': 'white', **sprite['options']},
+                    )
+                else:
+                    image = self.images.get(sprite['path'], sprite['frame'])
+                    sprite['item'] = self.canvas.create_image(
+                        *sprite['pos'], anchor='nw', image=image, state=state,
+                    )
+                self.restack_sprite(sprite)
+                continue
+            sprite.update(changes)
+            item = sprite['item']
+            if 'pos' in changes:
+                self.canvas.coords(item, *sprite['pos'])
+            if 'path' in changes or 'frame' in changes:
+                self.canvas.itemconfigure(item, image=self.images.get(sprite['path'], sprite['frame']))
+            if 'text' in changes:
+                self.canvas.itemconfigure(item, text=sprite['text'])
+            if 'font' in changes:
+                self.canvas.itemconfigure(item, font=self.get_font(sprite['font']))
+            if 'options' in changes:
+                self.canvas.itemconfigure(item, **sprite['options'])
+            if 'visible' in changes:
+                self.canvas.itemconfigure(item, state='normal' if sprite['visible'] else 'hidden')
+            if 'z' in changes:
+                self.restack_sprite(sprite)
+
+    def restack_sprite(self, sprite):
+        # place the sprite right below the lowest sprite with a greater z
+        # (sprites with the same z are stacked in creation order)
+        above = None
+        for other in self.sprites.values():
+            if (other['z'], other['id']) > (sprite['z'], sprite['id']):
+                if above is None or (other['z'], other['id']) < (above['z'], above['id']):
+                    above = other
+        if above:
+            self.canvas.tag_lower(sprite['item'], above['item'])
+        else:
+            self.canvas.tag_raise(sprite['item'])
+
+    def get_font(self, font):
+        "Get the `tkinter.font.Font` for a `(family, size, bold, italic)` tuple."
+        key = ('font', font)
+        if key not in self.assets:
+            family, size, bold, italic = font
+            self.assets[key] = tkfont.Font(
+                family=family,
+                size=size,
+                weight='bold' if bold else 'normal',
+                slant='italic' if italic else 'roman',
+            )
+        return self.assets[key]
+
+    def measure_text(self, font, text, response):
+        response.put(self.get_font(font).measure(text))
+
+    def font_metrics(self, font, response):
+        response.put(self.get_font(font).metrics())
 
     def get_image(self, path):
-        if path not in self.assets:
-            check_image_format(path)
-            self.assets[path] = tk.PhotoImage(file=path)
-        return self.assets[path]
+        return self.images.get(path)
+
+    def load_image(self, path, data):
+        self.images.load(path, data)
+
+    def sprite_sheet(self, path, frame_width, frame_height):
+        self.images.sheets[path] = (frame_width, frame_height)
+
+    def image_cache_size(self, size):
+        self.images.budget = size
+        self.images.evict()
+
+    def update_framebuffer(self, id, width, height, x, y, data):
+        key = ('framebuffer', id)
+        image = self.assets.get(key)
+        if image is None or (image.width(), image.height()) != (width, height):
+            image = self.assets[key] = tk.PhotoImage(width=width, height=height)
+        self.tk.call(image, 'put', data, '-format', 'ppm', '-to', x, y)
+
+    def draw_framebuffer(self, id, x, y):
+        self.draw_item('image', (x, y), {'anchor': 'nw', 'image': self.assets[('framebuffer', id)]})
+
+    def update_tile_chunk(self, id, chunk, atlas, tile_size, size, tiles):
+        key = ('tilechunk', id, chunk)
+        tw, th = tile_size
+        columns, rows = size
+        image = self.assets.get(key)
+        if image is None or (image.width(), image.height()) != (columns * tw, rows * th):
+            image = self.assets[key] = tk.PhotoImage(width=columns * tw, height=rows * th)
+        else:
+            image.blank()
+        sheet = self.images.get(atlas)
+        atlas_columns = sheet.width() // tw
+        for i, tile in enumerate(tiles):
+            if tile < 0:
+                continue
+            sx, sy = tile % atlas_columns * tw, tile // atlas_columns * th
+            x, y = i % columns * tw, i // columns * th
+            self.tk.call(image, 'copy', sheet, '-from', sx, sy, sx + tw, sy + th, '-to', x, y)
+
+    def draw_tile_chunk(self, id, chunk, x, y):
+        self.draw_item('image', (x, y), {'anchor': 'nw', 'image': self.assets[('tilechunk', id, chunk)]})
+
+    def drop_tile_chunks(self, id, chunks):
+        for chunk in chunks:
+            self.assets.pop(('tilechunk', id, chunk), None)
 
     def say(self, message, done):
         messagebox.showinfo(self.title(), message, parent=self)
@@ -120,8 +520,392 @@ class _TkWindow(tk.Tk):
     def input(self, prompt, response):
         response.put(simpledialog.askstring(self.title(), prompt, parent=self))
 
-    def with_window(self, func, args):
-        func(self, *args)
+class _Layer:
+    """
+    A group of items drawn on the window. Each item is a list
+    `[item_id, type, coords, options]`.
+
+    On each frame, the items drawn on a layer are matched by position against the
+    items drawn on the previous frame, so that unchanged items are kept and changed
+    items are only updated, instead of deleting and recreating everything.
+    """
+
+    def __init__(self, z, order):
+        self.z = z
+        self.order = order
+        self.items = []
+        self.cursor = 0
+        self.touched = False
+
+    def key(self):
+        return self.z, self.order
+
+class _ImageCache:
+    """
+    Cache of `tk.PhotoImage` objects, including frames of sprite sheets and
+    zoomed/subsampled variants, keyed by `(path, frame, zoom, subsample)`.
+
+    When the estimated memory used by the images exceeds `budget` bytes, the
+    least recently used images are evicted, except the ones used in the current
+    frame and the ones still shown by a canvas item (e.g. sprites and items in
+    layers that are not redrawn), since Tk would blank them.
+    """
+
+    def __init__(self, budget=64 * 1024 * 1024):
+        self.budget = budget
+        # key -> [image, size in bytes, frame in which it was last used]
+        self.images = OrderedDict()
+        self.size = 0
+        self.frame = 0
+        # path -> (frame_width, frame_height)
+        self.sheets = {}
+
+    def get(self, path, frame=None, zoom=1, subsample=1):
+        key = (path, frame, zoom, subsample)
+        entry = self.images.get(key)
+        if entry:
+            self.images.move_to_end(key)
+            entry[2] = self.frame
+            return entry[0]
+
+        if zoom != 1 or subsample != 1:
+            image = self.get(path, frame)
+            if zoom != 1:
+                image = image.zoom(zoom)
+            if subsample != 1:
+                image = image.subsample(subsample)
+        elif frame is not None:
+            image = self.get_frame(self.get(path), path, frame)
+        else:
+            check_image_format(path)
+            image = tk.PhotoImage(file=path)
+        self.add(key, image)
+        return image
+
+    def get_frame(self, sheet, path, frame):
+        if path not in self.sheets:
+            raise ValueError(f'{path} is not a sprite sheet; see gamelib.sprite_sheet()')
+        w, h = self.sheets[path]
+        columns = sheet.width() // w
+        x, y = frame % columns * w, frame // columns * h
+        image = tk.PhotoImage(width=w, height=h)
+        image.tk.call(image, 'copy', sheet, '-from', x, y, x + w, y + h, '-to', 0, 0)
+        return image
+
+    def load(self, path, data):
+        key = (path, None, 1, 1)
+        if key not in self.images:
+            check_image_format(path)
+            self.add(key, tk.PhotoImage(data=data))
+
+    def add(self, key, image):
+        size = image.width() * image.height() * 4
+        self.images[key] = [image, size, self.frame]
+        self.size += size
+        self.evict()
+
+    def evict(self):
+        if self.size <= self.budget:
+            return
+        for key, (image, size, last_used) in list(self.images.items()):
+            if self.size <= self.budget or last_used == self.frame:
+                # all remaining images are used in the current frame
+                break
+            if image.tk.getboolean(image.tk.call('image', 'inuse', image)):
+                continue
+            del self.images[key]
+            self.size -= size
+
+class _HeadlessWindow(_Window):
+    """
+    A window backend that does not display anything, and does not need a display
+    server. The draw commands of the last complete frame are recorded in `frame`
+    as `(type, coords, options)` tuples.
+    """
+
+    interactive = False
+
+    # Size assumed until resize is called (also used by gamelib_render)
+    DEFAULT_SIZE = (300, 300)
+
+    def __init__(self):
+        super().__init__()
+        self.window_title = "Gamelib"
+        self.size = None
+        self.canvas_size = self.DEFAULT_SIZE
+        self.layers = {}
+        self.select_layer(None, 0)
+        self.frame = []
+        self.framebuffers = {}
+        self.tile_chunks = {}
+        self.sprites = {}
+
+    def mainloop(self):
+        while not self.closed:
+            try:
+                # poll, so that close() from the signal handler is noticed
+                commands = [_Window.commands.get(timeout=0.1)]
+            except Empty:
+                continue
+            self.run_commands(commands + self.drain_commands())
+
+    def notify(self):
+        pass
+
+    def item_count(self):
+        return len(self.frame)
+
+    def show_stats(self, show):
+        pass
+
+    def report_callback_exception(self, *exc_info):
+        sys.excepthook(*exc_info)
+
+    def title(self, s):
+        self.window_title = s
+
+    def resize(self, w, h):
+        self.size = (w, h)
+        self.canvas_size = (w, h)
+
+    def icon(self, path):
+        pass
+
+    def clear(self):
+        self.select_layer(None, 0)
+
+    def layer(self, name, z):
+        self.select_layer(name, z)
+
+    def select_layer(self, name, z):
+        layer = self.layers.get(name)
+        if layer is None:
+            layer = self.layers[name] = _Layer(z, len(self.layers))
+        layer.z = z
+        if not layer.touched:
+            layer.items = []
+            layer.touched = True
+        self.current_layer = layer
+
+    def flush(self):
+        self.frame = []
+        for layer in sorted(self.layers.values(), key=_Layer.key):
+            self.frame += layer.items
+            layer.touched = False
+
+    def draw(self, type, args, kwargs):
+        self.draw_item(type, tuple(args), {'fill': 'white', **kwargs})
+
+    def draw_text(self, text, x, y, font, kwargs):
+        options = {'fill': 'white', **kwargs, 'text': text, 'font': font}
+        self.draw_item('text', (x, y), options)
+
+    def draw_image(self, path, x, y, frame=None, zoom=1, subsample=1):
+        options = {'image': path, 'frame': frame, 'zoom': zoom, 'subsample': subsample}
+        self.draw_item('image', (x, y), options)
+
+    def draw_item(self, type, coords, options):
+        self.current_layer.items.append((type, coords, options))
+
+    def update_framebuffer(self, id, width, height, x, y, data):
+        self.framebuffers[id] = (width, height)
+
+    def load_image(self, path, data):
+        pass
+
+    def sprite_sheet(self, path, frame_width, frame_height):
+        pass
+
+    def image_cache_size(self, size):
+        pass
+
+    def measure_text(self, font, text, response):
+        # rough approximation, since fonts are not available without a display
+        family, size, bold, italic = font
+        response.put(round(len(text) * size * 0.6))
+
+    def font_metrics(self, font, response):
+        family, size, bold, italic = font
+        descent = round(size * 0.25)
+        response.put({'ascent': size, 'descent': descent, 'linespace': size + descent, 'fixed': 0})
+
+    def draw_framebuffer(self, id, x, y):
+        self.draw_item('framebuffer', (x, y), {'framebuffer': id})
+
+    def update_tile_chunk(self, id, chunk, atlas, tile_size, size, tiles):
+        self.tile_chunks[(id, chunk)] = size
+
+    def draw_tile_chunk(self, id, chunk, x, y):
+        self.draw_item('tilechunk', (x, y), {'tilemap': id, 'chunk': chunk})
+
+    def drop_tile_chunks(self, id, chunks):
+        for chunk in chunks:
+            self.tile_chunks.pop((id, chunk), None)
+
+    def subscribe(self, event_types):
+        pass
+
+    def unsubscribe(self, event_types):
+        pass
+
+    def track_input(self, event_types):
+        pass
+
+    def update_sprites(self, updates):
+        for id, changes in updates.items():
+            if changes.get('destroy'):
+                self.sprites.pop(id, None)
+            elif id in self.sprites or 'path' in changes or 'text' in changes:
+                self.sprites.setdefault(id, {'id': id}).update(changes)
+
+    def say(self, message, done):
+        print(message)
+        done.put(True)
+
+    def input(self, prompt, response):
+        response.put(None)
+
+class _CaptureWindow(_HeadlessWindow):
+    """
+    Keeps track of what is displayed in the window, for `_FrameCapture`. `on_flush`
+    is called each time a frame is complete.
+    """
+
+    def __init__(self, on_flush):
+        super().__init__()
+        self.on_flush = on_flush
+
+    def draw_frame(self, commands, info):
+        methods = self.frame_methods
+        for method, *args in commands:
+            methods[method](*args)
+
+    def flush(self):
+        super().flush()
+        self.on_flush()
+
+class _FrameCapture:
+    """
+    Writes the frames drawn by the game to a gzip-compressed file in a background
+    thread, see `capture`.
+
+    The file is a sequence of pickled tuples:
+
+    * `('gamelib-capture', version)`
+    * `('framebuffer', id, width, height, x, y, ppm_data)`: A region of a
+      `Framebuffer` was updated.
+    * `('sprite_sheet', path, frame_width, frame_height)`
+    * `('tile_chunk', id, chunk, atlas, tile_size, size, tiles)`: A chunk of a
+      `TileMap` was updated.
+    * `('drop_tile_chunks', id, chunks)`: The chunks of a `TileMap` are no longer
+      needed.
+    * `('frame', index, size, items, sprites)`: A complete frame, where `items`
+      is the list of `(type, coords, options)` tuples drawn (see
+      `_HeadlessWindow`), and `sprites` is the list of visible sprites, as
+      dictionaries, in stacking order.
+
+    The game thread never waits for the writer: if more than `max_pending`
+    frames are waiting to be written, new frames are dropped without being queued.
+    Frames that redraw a layer other than the default one are still applied (but
+    not written), so that the following frames are complete, and pending sprite
+    updates are merged, so that the queue does not grow without bound.
+    """
+
+    VERSION = 1
+
+    # Commands sent to the window that change what is displayed
+    COMMANDS = _Window.FRAME_COMMANDS + (
+        'resize', 'draw_frame', 'update_framebuffer', 'update_tile_chunk', 'drop_tile_chunks',
+        'update_sprites', 'sprite_sheet',
+    )
+
+    def __init__(self, path, max_pending=60):
+        self.file = gzip.open(path, 'wb', compresslevel=1)
+        self.max_pending = max_pending
+        self.cond = threading.Condition()
+        # (command, frame index) tuples, where the index is None if the command
+        # is not a frame to be written; None to stop
+        self.commands = deque()
+        self.pending = 0
+        self.frames = 0
+        self.dropped = 0
+        self.frame_index = None
+        self.window = _CaptureWindow(self.on_flush)
+        self.dump(('gamelib-capture', self.VERSION))
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def put(self, command):
+        method = command[0]
+        with self.cond:
+            index = None
+            if method in ('draw_frame', 'flush'):
+                index = self.frames
+                self.frames += 1
+                if self.pending >= self.max_pending:
+                    self.dropped += 1
+                    if method == 'flush' or not command[2]['layers']:
+                        return
+                    index = None
+                else:
+                    self.pending += 1
+            elif method == 'update_sprites' and self.commands:
+                last = self.commands[-1]
+                if last and last[0][0] == 'update_sprites':
+                    updates = dict(last[0][1])
+                    for id, changes in command[1].items():
+                        updates[id] = {**updates.get(id, {}), **changes}
+                    self.commands[-1] = (('update_sprites', updates), None)
+                    return
+            self.commands.append((command, index))
+            self.cond.notify()
+
+    def close(self):
+        with self.cond:
+            self.commands.append(None)
+            self.cond.notify()
+
+    def join(self):
+        self.thread.join()
+        if self.dropped:
+            print(f'Warning: {self.dropped} frames were not captured because the capture file could not be written fast enough.')
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(lambda: self.commands)
+                    item = self.commands.popleft()
+                if item is None:
+                    break
+                (method, *args), self.frame_index = item
+                if method == 'update_framebuffer':
+                    self.dump(('framebuffer', *args))
+                elif method == 'sprite_sheet':
+                    self.dump(('sprite_sheet', *args))
+                elif method == 'update_tile_chunk':
+                    self.dump(('tile_chunk', *args))
+                elif method == 'drop_tile_chunks':
+                    self.dump(('drop_tile_chunks', *args))
+                getattr(self.window, method)(*args)
+                if self.frame_index is not None:
+                    with self.cond:
+                        self.pending -= 1
+        finally:
+            self.file.close()
+
+    def on_flush(self):
+        index = self.frame_index
+        if index is None:
+            return
+        sprites = sorted(
+            (sprite for sprite in self.window.sprites.values() if sprite.get('visible')),
+            key=lambda sprite: (sprite['z'], sprite['id']),
+        )
+        self.dump(('frame', index, self.window.size, self.window.frame, sprites))
+
+    def dump(self, record):
+        pickle.dump(record, self.file, pickle.HIGHEST_PROTOCOL)
 
 def check_image_format(path):
     "Produce a warning message if the image format is not supported"
@@ -138,108 +922,1182 @@ def check_audio_format(path):
         print(f"{path}: Warning: audio format {ext} is not supported and may not work properly on some platforms (Windows/Mac/Linux).")
         print(f"Please use WAV.")
 
-def _audio_init():
-    # shamelessly stolen from https://github.com/TaylorSMarks/playsound
+class _AudioError(Exception):
+    pass
 
-    class PlaysoundException(Exception):
+class _Voice:
+    """
+    A voice of the audio engine, i.e. something that can play one sound at a time.
+    `handle` is owned by the backend.
+    """
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.sound = None
+
+class _NullAudio:
+    """
+    Audio backend that does not produce any sound, used in headless mode and for
+    testing. Sounds are decoded with the `wave` module, and voices stay busy for
+    the duration of the sound, like in a real backend.
+    """
+
+    def __init__(self):
+        self.played = 0
+
+    def load(self, path):
+        with wave.open(path, 'rb') as w:
+            return w.getnframes() / w.getframerate()
+
+    def new_voice(self):
+        return _Voice(0.0)
+
+    def prepare(self, voice, sound):
         pass
 
-    def _playsoundWin(sound):
+    def release(self, voice):
+        voice.handle = 0.0
+
+    def play(self, voice, sound):
+        voice.handle = time.perf_counter() + sound
+        self.played += 1
+
+    def stop(self, voice):
+        voice.handle = 0.0
+
+    def is_playing(self, voice):
+        return time.perf_counter() < voice.handle
+
+# The platform backends are based on https://github.com/TaylorSMarks/playsound
+
+class _GstAudio:
+    "Audio backend for Linux, using GStreamer. Each voice is a `playbin`."
+
+    def __init__(self):
+        import gi
+        gi.require_version('Gst', '1.0')
+        from gi.repository import Gst
+
+        Gst.init(None)
+        self.Gst = Gst
+
+    def load(self, path):
+        from urllib.request import pathname2url
+
+        if path.startswith(('http://', 'https://')):
+            return path
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return 'file://' + pathname2url(os.path.abspath(path))
+
+    def new_voice(self):
+        voice = _Voice(self.Gst.ElementFactory.make('playbin', None))
+        voice.playing = False
+        return voice
+
+    def prepare(self, voice, uri):
+        # pausing the pipeline opens and decodes the beginning of the sound
+        playbin = voice.handle
+        playbin.set_state(self.Gst.State.NULL)
+        playbin.props.uri = uri
+        playbin.set_state(self.Gst.State.PAUSED)
+
+    def release(self, voice):
+        voice.handle.set_state(self.Gst.State.NULL)
+
+    def play(self, voice, uri):
+        Gst = self.Gst
+        playbin = voice.handle
+        if voice.sound == uri:
+            # same sound as last time (or preloaded): just rewind it
+            playbin.seek_simple(Gst.Format.TIME, Gst.SeekFlags.FLUSH, 0)
+        else:
+            playbin.set_state(Gst.State.NULL)
+            playbin.props.uri = uri
+        if playbin.set_state(Gst.State.PLAYING) == Gst.StateChangeReturn.FAILURE:
+            playbin.set_state(Gst.State.NULL)
+            raise _AudioError(f'Could not play {uri}')
+        voice.playing = True
+
+    def stop(self, voice):
+        voice.handle.set_state(self.Gst.State.PAUSED)
+        voice.playing = False
+
+    def is_playing(self, voice):
+        Gst = self.Gst
+        message = voice.handle.get_bus().pop_filtered(Gst.MessageType.EOS | Gst.MessageType.ERROR)
+        if message:
+            voice.playing = False
+            if message.type == Gst.MessageType.ERROR:
+                voice.handle.set_state(Gst.State.NULL)
+                voice.sound = None
+        return voice.playing
+
+class _WinAudio:
+    "Audio backend for Windows, using MCI. Each voice is an MCI alias."
+
+    def __init__(self):
         from ctypes import c_buffer, windll
-        from random import random
-        from sys    import getfilesystemencoding
-
-        def winCommand(*command):
-            buf = c_buffer(255)
-            command = ' '.join(command).encode(getfilesystemencoding())
-            errorCode = int(windll.winmm.mciSendStringA(command, buf, 254, 0))
-            if errorCode:
-                errorBuffer = c_buffer(255)
-                windll.winmm.mciGetErrorStringA(errorCode, errorBuffer, 254)
-                exceptionMessage = ('\n    Error ' + str(errorCode) + ' for command:'
-                                    '\n        ' + command.decode() +
-                                    '\n    ' + errorBuffer.value.decode(getfilesystemencoding(), 'ignore'))
-                raise PlaysoundException(exceptionMessage)
-            return buf.value
-
-        alias = 'playsound_' + str(random())
-        winCommand('open "' + sound + '" alias', alias)
-        winCommand('set', alias, 'time format milliseconds')
-        durationInMS = winCommand('status', alias, 'length')
-        winCommand('play', alias, 'from 0 to', durationInMS.decode())
-
-    def _playsoundOSX(sound):
-        from AppKit     import NSSound
+
+        self.c_buffer = c_buffer
+        self.winmm = windll.winmm
+        self.voices = itertools.count()
+
+    def command(self, *command):
+        encoding = sys.getfilesystemencoding()
+        buf = self.c_buffer(255)
+        command = ' '.join(command).encode(encoding)
+        errorCode = int(self.winmm.mciSendStringA(command, buf, 254, 0))
+        if errorCode:
+            errorBuffer = self.c_buffer(255)
+            self.winmm.mciGetErrorStringA(errorCode, errorBuffer, 254)
+            raise _AudioError(
+                f'Error {errorCode} for command: {command.decode()}: '
+                + errorBuffer.value.decode(encoding, 'ignore')
+            )
+        return buf.value
+
+    def load(self, path):
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return os.path.abspath(path)
+
+    def new_voice(self):
+        return _Voice(f'gamelib_{next(self.voices)}')
+
+    def prepare(self, voice, path):
+        alias = voice.handle
+        if voice.sound:
+            self.command('close', alias)
+        voice.sound = None
+        self.command(f'open "{path}" alias', alias)
+
+    def release(self, voice):
+        if voice.sound:
+            self.command('close', voice.handle)
+
+    def play(self, voice, path):
+        if voice.sound != path:
+            self.prepare(voice, path)
+        self.command('play', voice.handle, 'from 0')
+
+    def stop(self, voice):
+        self.command('stop', voice.handle)
+
+    def is_playing(self, voice):
+        return self.command('status', voice.handle, 'mode') == b'playing'
+
+class _MacAudio:
+    "Audio backend for Mac OS, using AppKit. Each voice is an `NSSound`."
+
+    def __init__(self):
+        from AppKit import NSSound
         from Foundation import NSURL
 
-        if '://' not in sound:
-            if not sound.startswith('/'):
-                sound = os.getcwd() + '/' + sound
-            sound = 'file://' + sound
-        url   = NSURL.URLWithString_(sound)
-        nssound = NSSound.alloc().initWithContentsOfURL_byReference_(url, True)
-        if not nssound:
-            raise IOError('Unable to load sound named: ' + sound)
-        nssound.play()
-
-    def _playsoundNix(sound):
-        from urllib.request import pathname2url
+        self.NSSound = NSSound
+        self.NSURL = NSURL
+
+    def load(self, path):
+        if '://' in path:
+            return path
+        if not os.path.exists(path):
+            raise FileNotFoundError(path)
+        return 'file://' + os.path.abspath(path)
+
+    def new_voice(self):
+        return _Voice(None)
+
+    def prepare(self, voice, url):
+        nsurl = self.NSURL.URLWithString_(url)
+        voice.handle = self.NSSound.alloc().initWithContentsOfURL_byReference_(nsurl, True)
+        if not voice.handle:
+            raise IOError('Unable to load sound named: ' + url)
+
+    def release(self, voice):
+        if voice.handle:
+            voice.handle.stop()
+        voice.handle = None
+
+    def play(self, voice, url):
+        if voice.sound != url:
+            self.prepare(voice, url)
+        voice.handle.stop()
+        voice.handle.play()
+
+    def stop(self, voice):
+        voice.handle.stop()
+
+    def is_playing(self, voice):
+        return bool(voice.handle and voice.handle.isPlaying())
+
+try:
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', DeprecationWarning)
+        import audioop as _audioop
+except ImportError:
+    # removed in Python 3.13; the _pcm_* functions fall back to pure Python
+    _audioop = None
+
+def _pcm_convert(data, width, channels, rate, out_rate, state):
+    """
+    Convert PCM data in WAV format to 16 bit stereo at `out_rate` Hz. Returns the
+    converted data and the state to be passed in the next call.
+    """
+    if channels > 2:
+        raise ValueError('Only mono and stereo sounds are supported')
+    if _audioop:
+        if width == 1:
+            # 8 bit WAV samples are unsigned
+            data = _audioop.bias(data, 1, -128)
+        if width != 2:
+            data = _audioop.lin2lin(data, width, 2)
+        if channels == 1:
+            data = _audioop.tostereo(data, 2, 1, 1)
+        if rate != out_rate:
+            data, state = _audioop.ratecv(data, 2, 2, rate, out_rate, state)
+        return data, state
+
+    if width == 1:
+        samples = array('h', ((b - 128) << 8 for b in data))
+    else:
+        # keep the two most significant bytes of each sample
+        samples = array('h', b''.join(data[i + width - 2:i + width] for i in range(0, len(data), width)))
+    if channels == 1:
+        stereo = array('h', bytes(len(samples) * 4))
+        stereo[0::2] = samples
+        stereo[1::2] = samples
+        samples = stereo
+    if rate != out_rate:
+        # nearest neighbour; the state is the position of the next input frame
+        position = state or 0.0
+        step = rate / out_rate
+        frames = len(samples) // 2
+        resampled = array('h')
+        while position < frames:
+            i = int(position) * 2
+            resampled.append(samples[i])
+            resampled.append(samples[i + 1])
+            position += step
+        samples, state = resampled, position - frames
+    return samples.tobytes(), state
+
+def _pcm_mix(mix, data, volume):
+    """
+    Add the 16 bit samples in `data`, scaled by `volume`, to `mix` (`None` for the
+    first sound). The result must be converted with `_pcm_clip`.
+    """
+    if _audioop:
+        if volume != 1:
+            data = _audioop.mul(data, 2, volume)
+        return _audioop.add(mix, data, 2) if mix else data
+    # Without audioop, the samples are accumulated without clipping in an
+    # array('i'), and the arithmetic is done with map() and the operator
+    # module, so that it runs in C instead of one Python expression per sample.
+    samples = array('h', data)
+    if volume != 1:
+        # fixed point, 8 bit fraction
+        scaled = map(operator.mul, samples, itertools.repeat(round(volume * 256)))
+        samples = map(operator.rshift, scaled, itertools.repeat(8))
+    if mix is None:
+        return array('i', samples)
+    return array('i', map(operator.add, mix, samples))
+
+def _pcm_clip(mix):
+    "Convert the result of `_pcm_mix` to 16 bit samples."
+    if _audioop:
+        return mix
+    clipped = map(min, map(max, mix, itertools.repeat(-32768)), itertools.repeat(32767))
+    return array('h', clipped).tobytes()
+
+class _WaveStream:
+    """
+    Reads a WAV file in small chunks, converted to the mixer format, so that long
+    sounds (e.g. music) are never loaded entirely in memory.
+    """
+
+    def __init__(self, path, rate):
+        self.wave = wave.open(path, 'rb')
+        self.rate = rate
+        self.state = None
+        self.buffer = bytearray()
+
+    def duration(self):
+        return self.wave.getnframes() / self.wave.getframerate()
+
+    def read(self, n):
+        "Read `n` frames, or less at the end of the file."
+        w = self.wave
+        size = n * 4
+        while len(self.buffer) < size:
+            data = w.readframes(max(n, 4096))
+            if not data:
+                break
+            data, self.state = _pcm_convert(
+                data, w.getsampwidth(), w.getnchannels(), w.getframerate(), self.rate, self.state,
+            )
+            self.buffer += data
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def rewind(self):
+        self.wave.rewind()
+        self.state = None
+        self.buffer.clear()
+
+    def close(self):
+        self.wave.close()
+
+class _SampleReader:
+    "Reads a sound that is already decoded in memory, see `_Mixer.sample`."
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, n):
+        data = self.data[self.pos:self.pos + n * 4]
+        self.pos += len(data)
+        return data
+
+    def rewind(self):
+        self.pos = 0
+
+    def close(self):
+        pass
+
+class _MixerChannel:
+    def __init__(self, path, volume, start, loop):
+        self.path = path
+        self.volume = volume
+        # mixer frame at which the sound starts
+        self.start = start
+        self.loop = loop
+        self.source = None
+        self.done = False
+
+class _NullSink:
+    "Discards the mixed audio. It is paced by the wall clock, like a sound card."
+
+    def __init__(self):
+        self.frames = 0
 
+    def write(self, data):
+        self.frames += len(data) // 4
+
+    def close(self):
+        pass
+
+class _WaveFileSink:
+    "Writes the mixed audio to a WAV file."
+
+    def __init__(self, path, rate):
+        self.wave = wave.open(path, 'wb')
+        self.wave.setnchannels(2)
+        self.wave.setsampwidth(2)
+        self.wave.setframerate(rate)
+
+    def write(self, data):
+        self.wave.writeframesraw(data)
+
+    def close(self):
+        self.wave.close()
+
+class _GstSink:
+    "Plays the mixed audio with GStreamer (Linux)."
+
+    def __init__(self, rate):
         import gi
         gi.require_version('Gst', '1.0')
         from gi.repository import Gst
 
         Gst.init(None)
+        self.Gst = Gst
+        self.pipeline = Gst.parse_launch(
+            'appsrc name=src format=time block=true max-bytes=16384'
+            f' caps=audio/x-raw,format=S16LE,rate={rate},channels=2,layout=interleaved'
+            ' ! audioconvert ! autoaudiosink'
+        )
+        self.src = self.pipeline.get_by_name('src')
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def write(self, data):
+        self.src.emit('push-buffer', self.Gst.Buffer.new_wrapped(data))
+
+    def close(self):
+        self.src.emit('end-of-stream')
+        self.pipeline.set_state(self.Gst.State.NULL)
+
+class _Mixer:
+    """
+    Software mixer: mixes up to `max_channels` sounds plus the music, in a
+    background thread, and writes the result to a sink (an object with `write`
+    and `close` methods; see `_NullSink`). The output is 16 bit stereo at `rate` Hz.
+
+    The mixer counts time in frames of audio (`clock`). Sounds are scheduled
+    relative to the start of the current game frame (`frame_base`), so that two
+    sounds played `n` game frames apart are exactly `n / fps` seconds apart. When
+    the game runs uncapped (see `replay`), the mixer renders exactly `rate / fps`
+    frames of audio per game frame instead of following the wall clock.
+    """
+
+    # Frames of audio rendered at a time
+    CHUNK = 1024
+
+    # Seconds of audio rendered ahead of time
+    LEAD = 0.1
+
+    # Sounds shorter than this many seconds are decoded once and kept in memory;
+    # longer ones are streamed from the file
+    STREAM_SECONDS = 5
+
+    def __init__(self, sink, rate=22050, max_channels=16, cache_size=32 * 1024 * 1024):
+        self.sink = sink
+        self.rate = rate
+        self.max_channels = max_channels
+        self.cond = threading.Condition()
+        # _MixerChannels, in the order they started
+        self.channels = []
+        self.music = None
+        # path -> decoded sound, see sample
+        self.samples = OrderedDict()
+        self.samples_lock = threading.Lock()
+        self.cache_size = cache_size
+        self.clock = 0
+        self.frame_base = 0.0
+        self.frame_length = rate / 30
+        self.frame_driven = False
+        self.frame_target = 0.0
+        self.start_time = time.perf_counter()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def on_frame(self, frame_start, fps, uncapped):
+        "Called by the game thread at the start of each frame."
+        with self.cond:
+            self.frame_length = self.rate / fps
+            if uncapped:
+                self.frame_driven = True
+                self.frame_base = self.frame_target
+                self.frame_target += self.frame_length
+            else:
+                self.frame_base = (frame_start - self.start_time + self.LEAD) * self.rate
+            self.cond.notify()
+
+    def target(self):
+        "The mixer frame up to which audio should be rendered."
+        if self.frame_driven:
+            return self.frame_target
+        return (time.perf_counter() - self.start_time + self.LEAD) * self.rate
+
+    def play(self, path, volume=1.0, delay=0, loop=False, music=False):
+        with self.cond:
+            start = max(self.clock, int(self.frame_base + delay * self.frame_length))
+            channel = _MixerChannel(path, volume, start, loop)
+            if music:
+                if self.music:
+                    self.music.done = True
+                self.music = channel
+                return
+            self.channels.append(channel)
+            while len(self.channels) > self.max_channels:
+                self.channels.pop(0).done = True
+
+    def set_max_channels(self, n):
+        with self.cond:
+            self.max_channels = n
+            while len(self.channels) > n:
+                self.channels.pop(0).done = True
+
+    def stop(self, music=False):
+        with self.cond:
+            if music:
+                if self.music:
+                    self.music.done = True
+                self.music = None
+            else:
+                for channel in self.channels:
+                    channel.done = True
+                self.channels = []
+
+    def set_music_volume(self, volume):
+        with self.cond:
+            if self.music:
+                self.music.volume = volume
+
+    def sample(self, path):
+        "Return the decoded sound, or `None` if it is too long to be kept in memory."
+        with self.samples_lock:
+            if path in self.samples:
+                self.samples.move_to_end(path)
+                return self.samples[path]
+        stream = _WaveStream(path, self.rate)
+        try:
+            if stream.duration() > self.STREAM_SECONDS:
+                return None
+            w = stream.wave
+            data = stream.read(math.ceil(w.getnframes() * self.rate / w.getframerate()) + self.CHUNK)
+        finally:
+            stream.close()
+        with self.samples_lock:
+            self.samples[path] = data
+            while sum(map(len, self.samples.values())) > self.cache_size and len(self.samples) > 1:
+                self.samples.popitem(last=False)
+        return data
+
+    def open(self, path):
+        data = self.sample(path)
+        if data is None:
+            return _WaveStream(path, self.rate)
+        return _SampleReader(data)
+
+    def read(self, channel, n):
+        if channel.source is None:
+            try:
+                channel.source = self.open(channel.path)
+            except (OSError, EOFError, ValueError, wave.Error) as e:
+                print(f"{channel.path}: Warning: could not play sound: {e}")
+                channel.done = True
+                return b''
+        data = channel.source.read(n)
+        while len(data) < n * 4 and channel.loop:
+            channel.source.rewind()
+            more = channel.source.read(n - len(data) // 4)
+            if not more:
+                break
+            data += more
+        if len(data) < n * 4:
+            channel.done = True
+        return data
+
+    def render(self, n):
+        with self.cond:
+            channels = list(self.channels)
+            if self.music:
+                channels.append(self.music)
+        size = n * 4
+        end = self.clock + n
+        mix = None
+        for channel in channels:
+            if channel.start >= end or channel.done:
+                continue
+            offset = max(0, channel.start - self.clock)
+            data = self.read(channel, n - offset)
+            if offset:
+                data = bytes(offset * 4) + data
+            if len(data) < size:
+                data += bytes(size - len(data))
+            mix = _pcm_mix(mix, data, channel.volume)
+        with self.cond:
+            for channel in channels:
+                if channel.done and channel.source:
+                    channel.source.close()
+            self.channels = [c for c in self.channels if not c.done]
+            if self.music and self.music.done:
+                self.music = None
+            self.clock = end
+        return bytes(size) if mix is None else _pcm_clip(mix)
+
+    def run(self):
+        try:
+            while True:
+                with self.cond:
+                    self.cond.wait_for(
+                        lambda: not self.running or self.clock < self.target(),
+                        timeout=self.CHUNK / self.rate / 2,
+                    )
+                    target = self.target()
+                    if not self.running and (not self.frame_driven or self.clock >= target):
+                        break
+                    if self.clock >= target:
+                        continue
+                    n = min(self.CHUNK, math.ceil(target - self.clock))
+                self.sink.write(self.render(n))
+        except Exception:
+            sys.excepthook(*sys.exc_info())
+        finally:
+            self.sink.close()
+
+    def close(self):
+        with self.cond:
+            self.running = False
+            self.cond.notify()
+        self.thread.join(1)
+
+class _AudioEngine:
+    """
+    Plays sounds in a background thread, so that the game thread never waits for
+    the audio backend.
 
-        playbin = Gst.ElementFactory.make('playbin', 'playbin')
-        if sound.startswith(('http://', 'https://')):
-            playbin.props.uri = sound
+    The backend is initialized once, on the first request. Sounds are loaded
+    once and cached. At most `max_voices` sounds are played at the same time:
+    voices are reused when their sound ends, and when all of them are busy the
+    oldest sound is stopped to play the new one.
+    """
+
+    BACKENDS = {
+        'null': _NullAudio,
+        'gstreamer': _GstAudio,
+        'windows': _WinAudio,
+        'mac': _MacAudio,
+    }
+
+    def __init__(self, max_voices=8):
+        self.max_voices = max_voices
+        # Name of the backend, or None to choose it according to the platform
+        self.backend_name = None
+        self.backend = None
+        self.requests = Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.sounds = {}
+        self.voices = []
+        # Voices in the order they started playing
+        self.playing = deque()
+        self.stolen = 0
+        # See start_mixer; mixer_failed is set if there is no audio output for it
+        self.mixer = None
+        self.mixer_failed = False
+        self.warned = set()
+
+    def request(self, *args):
+        with self.lock:
+            if not self.thread:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+        self.requests.put(args)
+
+    def run(self):
+        self.backend = self.create_backend()
+        while True:
+            method, *args = self.requests.get()
+            try:
+                getattr(self, method)(*args)
+            except Exception as e:
+                print(f"Warning: could not {method} sound: {e}")
+
+    def create_backend(self):
+        name = self.backend_name or os.environ.get('GAMELIB_AUDIO')
+        if not name:
+            from platform import system
+            name = {'Windows': 'windows', 'Darwin': 'mac'}.get(system(), 'gstreamer')
+        try:
+            return self.BACKENDS[name]()
+        except Exception as e:
+            print(f"Warning: could not initialize the {name} audio backend, sounds are disabled: {e!r}")
+            return _NullAudio()
+
+    def load(self, path):
+        sound = self.sounds.get(path)
+        if sound is None:
+            sound = self.sounds[path] = self.backend.load(path)
+        return sound
+
+    def preload(self, path):
+        if self.mixer:
+            self.mixer.sample(path)
+            return
+        sound = self.load(path)
+        if any(voice.sound == sound for voice in self.voices):
+            return
+        # open the sound in a voice that is not used yet, if any, so that
+        # play() finds it ready
+        playing = self.busy_voices()
+        unused = [voice for voice in self.voices if voice not in playing and voice.sound is None]
+        if unused:
+            voice = unused[0]
+        elif len(self.voices) < self.max_voices:
+            voice = self.backend.new_voice()
+            self.voices.append(voice)
         else:
-            playbin.props.uri = 'file://' + pathname2url(os.path.abspath(sound))
+            return
+        try:
+            self.backend.prepare(voice, sound)
+        except Exception:
+            voice.sound = None
+            raise
+        voice.sound = sound
+
+    def start_mixer(self, sink=None, rate=22050):
+        if self.mixer:
+            self.mixer.close()
+            self.mixer = None
+        sink = self.create_sink(sink, rate)
+        self.mixer_failed = sink is None
+        if sink:
+            self.mixer = _Mixer(sink, rate, self.max_voices)
+
+    def get_mixer(self):
+        "Return the mixer, starting it if needed, or `None` if there is no audio output for it."
+        if not self.mixer and not self.mixer_failed:
+            self.start_mixer()
+        return self.mixer
+
+    def warn(self, message):
+        if message not in self.warned:
+            self.warned.add(message)
+            print(f"Warning: {message}")
+
+    def create_sink(self, sink, rate):
+        if sink is None:
+            null = 'null' in (self.backend_name, os.environ.get('GAMELIB_AUDIO'))
+            sink = 'null' if null else 'platform'
+        if sink == 'null':
+            return _NullSink()
+        if sink == 'platform':
+            try:
+                return _GstSink(rate)
+            except Exception as e:
+                self.warn(f"the software mixer is not available on this platform: {e!r}")
+                return None
+        if isinstance(sink, str):
+            return _WaveFileSink(sink, rate)
+        return sink
+
+    def play(self, path):
+        sound = self.load(path)
+        voice = self.get_voice(sound)
+        try:
+            self.backend.play(voice, sound)
+        except Exception:
+            voice.sound = None
+            raise
+        voice.sound = sound
+        self.playing.append(voice)
+
+    def stop_all(self):
+        while self.playing:
+            self.backend.stop(self.playing.popleft())
+
+    def set_max_voices(self, n):
+        "Change `max_voices`, stopping the oldest sounds and releasing the voices beyond the limit."
+        self.max_voices = n
+        backend = self.backend
+        playing = self.busy_voices()
+        while len(playing) > n:
+            backend.stop(playing.popleft())
+        excess = max(0, len(self.voices) - n)
+        for voice in [voice for voice in self.voices if voice not in playing][:excess]:
+            backend.release(voice)
+            self.voices.remove(voice)
+
+    def busy_voices(self):
+        "Forget the voices that finished playing, and return the ones still playing."
+        backend = self.backend
+        for voice in list(self.playing):
+            if not backend.is_playing(voice):
+                self.playing.remove(voice)
+        return self.playing
+
+    def get_voice(self, sound):
+        backend = self.backend
+        self.busy_voices()
+        idle = [voice for voice in self.voices if voice not in self.playing]
+        if idle:
+            # prefer a voice that already has the sound loaded
+            for voice in idle:
+                if voice.sound == sound:
+                    return voice
+            return idle[0]
+        if len(self.voices) < self.max_voices:
+            voice = backend.new_voice()
+            self.voices.append(voice)
+            return voice
+        voice = self.playing.popleft()
+        backend.stop(voice)
+        self.stolen += 1
+        return voice
+
+class _FrameScheduler:
+    """
+    Keeps `loop` running at a steady frame rate, and records how long each frame
+    took.
+    """
 
-        set_result = playbin.set_state(Gst.State.PLAYING)
-        if set_result != Gst.StateChangeReturn.ASYNC:
-            raise PlaysoundException(
-                "playbin.set_state returned " + repr(set_result))
+    # Sleep until this many seconds before the deadline, then spin (yielding
+    # the GIL to the window thread); time.sleep alone is too coarse on some
+    # platforms.
+    SPIN_MARGIN = 0.002
+
+    # In catch_up mode, never try to make up for more than this many frames.
+    MAX_LAG_FRAMES = 5
+
+    # If True, do not wait at all, and pretend that each frame took exactly
+    # 1 / fps seconds.
+    uncapped = False
+
+    def __init__(self, history=1000):
+        self.frame_duration = None
+        self.deadline = None
+        self.frame_start = None
+        self.interval = 0.0
+        self.frames = 0
+        self.missed = 0
+        self.frame_times = deque(maxlen=history)
+        self.frame_starts = deque(maxlen=history)
+
+    def wait(self, fps, catch_up=False):
+        self.wait_until(self.end_frame(fps, catch_up))
+        self.start_frame()
+
+    def end_frame(self, fps, catch_up):
+        "Record the end of the current frame, and return when the next one should start."
+        now = time.perf_counter()
+        frame_duration = 1.0 / fps
+        if self.deadline is None or frame_duration != self.frame_duration:
+            self.frame_duration = frame_duration
+            self.deadline = now
+            return now
+        self.frame_times.append(now - self.frame_start)
+        self.frames += 1
+        if self.uncapped:
+            self.deadline = now
+        elif now > self.deadline:
+            self.missed += 1
+            # In catch_up mode the absolute schedule is kept, so that the
+            # next frames run without waiting until the game catches up.
+            # Otherwise the missed frames are skipped.
+            if not catch_up or now - self.deadline > frame_duration * self.MAX_LAG_FRAMES:
+                self.deadline = now
+        return self.deadline
+
+    def start_frame(self):
+        self.deadline += self.frame_duration
+        frame_start = time.perf_counter()
+        if self.uncapped:
+            self.interval = self.frame_duration
+        else:
+            self.interval = frame_start - self.frame_start if self.frame_start else 0.0
+        self.frame_start = frame_start
+        self.frame_starts.append(frame_start)
+
+    def wait_until(self, deadline):
+        remaining = deadline - time.perf_counter()
+        if remaining > self.SPIN_MARGIN:
+            time.sleep(remaining - self.SPIN_MARGIN)
+        while time.perf_counter() < deadline:
+            time.sleep(0)
+
+    def fps(self, frames=None):
+        "Measured frames per second over the last `frames` frames."
+        starts = self.frame_starts
+        n = min(len(starts), frames or len(starts))
+        if n < 2 or starts[-1] == starts[-n]:
+            return 0.0
+        return (n - 1) / (starts[-1] - starts[-n])
+
+    def stats(self):
+        times = sorted(self.frame_times)
+        n = len(times)
+        return {
+            'frames': self.frames,
+            'missed': self.missed,
+            'fps': self.fps(),
+            'min': times[0] if n else 0.0,
+            'avg': sum(times) / n if n else 0.0,
+            'p99': times[min(n - 1, int(n * 0.99))] if n else 0.0,
+            'max': times[-1] if n else 0.0,
+        }
+
+def _bulk_args(coords, stride, colors):
+    "Convert the arguments of the bulk draw_* functions to plain lists"
+    if hasattr(coords, 'ravel'):
+        # NumPy array
+        coords = coords.ravel()
+    coords = coords.tolist() if hasattr(coords, 'tolist') else list(coords)
+    if len(coords) % stride:
+        raise ValueError(f'The amount of coordinates must be a multiple of {stride}')
+    if colors is not None:
+        colors = list(colors)
+        if len(colors) != len(coords) // stride:
+            raise ValueError('There must be one color per item')
+    return coords, colors
+
+class _EventQueue:
+    """
+    The queue of events sent by the window to the game thread. It holds at most
+    `max_events` events; when full, either the oldest or the new event is
+    dropped. If `coalesce_motion` is set, consecutive `Motion` events are
+    replaced by the latest one. `None` is sent when the window is closed, and is
+    never dropped.
+    """
 
-        bus = playbin.get_bus()
-        bus.add_signal_watch()
-        def on_message(bus, message):
-            if message.type in (Gst.MessageType.EOS, Gst.MessageType.ERROR):
-                playbin.set_state(Gst.State.NULL)
-        bus.connect("message", on_message)
+    def __init__(self, max_events=1000, drop_oldest=True, coalesce_motion=False):
+        self.cond = threading.Condition()
+        self.events = deque()
+        self.dropped = 0
+        # Function called from the window thread when an event is queued, see
+        # _AsyncBridge
+        self.listener = None
+        self.configure(max_events, drop_oldest, coalesce_motion)
+
+    def configure(self, max_events, drop_oldest, coalesce_motion):
+        with self.cond:
+            self.max_events = max_events
+            self.drop_oldest = drop_oldest
+            self.coalesce_motion = coalesce_motion
+
+    def put(self, event):
+        with self.cond:
+            events = self.events
+            if (
+                event and self.coalesce_motion and event.type == EventType.Motion
+                and events and events[-1] and events[-1].type == EventType.Motion
+            ):
+                events[-1] = event
+                return
+            if event and len(events) >= self.max_events:
+                self.dropped += 1
+                if not self.drop_oldest:
+                    return
+                if events[0] is not None:
+                    events.popleft()
+                elif len(events) > 1:
+                    # skip the window closed sentinel
+                    del events[1]
+            events.append(event)
+            self.cond.notify()
+        if self.listener:
+            self.listener()
+
+    def get(self, block=True):
+        with self.cond:
+            if block:
+                self.cond.wait_for(lambda: self.events)
+            if not self.events:
+                raise Empty
+            return self.events.popleft()
+
+class _InputState:
+    """
+    The state of the keyboard and mouse, updated by the window as events arrive
+    and queried by the game thread.
 
-    from platform import system
-    system = system()
+    `pressed` and `released` accumulate the keys and mouse buttons (as
+    `('key', key)` or `('button', button)` tuples) pressed and released since the
+    last call to `next_frame`, which makes them available as `frame_pressed` and
+    `frame_released`.
+    """
 
-    def play_sound(sound):
-        """
-        Play a sound located at the given path.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = set()
+        self.buttons = set()
+        self.mouse = (0, 0)
+        self.pressed = set()
+        self.released = set()
+        self.frame_pressed = set()
+        self.frame_released = set()
+
+    def update(self, event):
+        with self.lock:
+            t = event.type
+            if t == EventType.KeyPress:
+                self.keys.add(event.key)
+                self.pressed.add(('key', event.key))
+            elif t == EventType.KeyRelease:
+                self.keys.discard(event.key)
+                self.released.add(('key', event.key))
+            else:
+                self.mouse = (event.x, event.y)
+                if t == EventType.ButtonPress:
+                    self.buttons.add(event.mouse_button)
+                    self.pressed.add(('button', event.mouse_button))
+                elif t == EventType.ButtonRelease:
+                    self.buttons.discard(event.mouse_button)
+                    self.released.add(('button', event.mouse_button))
+
+    def next_frame(self):
+        with self.lock:
+            self.frame_pressed, self.pressed = self.pressed, set()
+            self.frame_released, self.released = self.released, set()
+
+class _Recording:
+    """
+    The file format used by `record` and `replay`: a header with the seed of the
+    `random` module, followed by one record for each event delivered to the game,
+    and a final record with the amount of frames. All integers are little-endian.
+    """
 
-        Example:
-            ```
-            gamelib.play_sound('sound/jump.wav')
-            ```
+    MAGIC = b'GLRC'
+    VERSION = 1
+
+    # magic, version, random seed
+    HEADER = struct.Struct('<4sBQ')
+
+    # frame, event type, mouse button, x, y, state, length of key, length of char
+    # (followed by the key and char, encoded in UTF-8)
+    EVENT = struct.Struct('<IBbiiIBB')
+
+    # event type of the final record
+    END = 255
+
+    @staticmethod
+    def event_types():
+        return list(EventType)
+
+class _Recorder(_Recording):
+    "Writes the events delivered to the game, see `record`."
+
+    def __init__(self, path, seed):
+        self.file = open(path, 'wb')
+        self.file.write(self.HEADER.pack(self.MAGIC, self.VERSION, seed))
+        self.types = {t: i for i, t in enumerate(self.event_types())}
+        self.lock = threading.Lock()
+
+    def write(self, frame, events):
+        with self.lock:
+            if self.file.closed:
+                return
+            for event in events:
+                key = str(event.key).encode()[:255]
+                char = (event.char or '').encode()[:255]
+                state = event.state
+                self.file.write(self.EVENT.pack(
+                    frame,
+                    self.types[event.type],
+                    event.mouse_button if isinstance(event.mouse_button, int) else -1,
+                    event.x if isinstance(event.x, int) else 0,
+                    event.y if isinstance(event.y, int) else 0,
+                    state if isinstance(state, int) else 0,
+                    len(key),
+                    len(char),
+                ))
+                self.file.write(key)
+                self.file.write(char)
+
+    def close(self, frames):
+        with self.lock:
+            if not self.file.closed:
+                self.file.write(self.EVENT.pack(frames, self.END, -1, 0, 0, 0, 0, 0))
+                self.file.close()
+
+class _Replayer(_Recording):
+    "Reads the events written by `_Recorder`, see `replay`."
+
+    def __init__(self, path):
+        self.file = open(path, 'rb')
+        magic, version, self.seed = self.HEADER.unpack(self.file.read(self.HEADER.size))
+        if magic != self.MAGIC or version != self.VERSION:
+            raise ValueError(f'{path} is not a gamelib recording')
+        self.types = self.event_types()
+        self.frames = None
+        self.finished = False
+        self.next = self.read()
+
+    def read(self):
+        "Read the next event as a `(frame, event)` tuple, or `None` at the end."
+        data = self.file.read(self.EVENT.size)
+        if len(data) < self.EVENT.size:
+            # truncated recording (e.g. the game crashed)
+            self.file.close()
+            return None
+        frame, t, button, x, y, state, key_len, char_len = self.EVENT.unpack(data)
+        if t == self.END:
+            self.frames = frame
+            self.file.close()
+            return None
+        key = self.file.read(key_len).decode()
+        char = self.file.read(char_len).decode()
+        raw = tuple(
+            char if k == 'char' else state if k == 'state' else None
+            for k in Event.RAW_ATTRIBUTES
+        )
+        return frame, Event(self.types[t], key, button if button >= 0 else '??', x, y, raw)
+
+    def next_event(self):
+        "Return the next event regardless of its frame, or `None` at the end."
+        if not self.next:
+            self.finished = True
+            return None
+        frame, event = self.next
+        self.next = self.read()
+        _GameThread.input_state.update(event)
+        return event
 
-        Note:
-            The only sound format that is supported accross all platforms (Windows/Mac/Linux)
-            is WAV.
+    def frame_events(self, frame):
+        "Return the events recorded up to the given frame."
+        events = []
+        while self.next and self.next[0] <= frame:
+            events.append(self.next[1])
+            _GameThread.input_state.update(events[-1])
+            self.next = self.read()
+        if not self.next and (self.frames is None or frame > self.frames):
+            self.finished = True
+        return events
+
+class _AsyncBridge:
+    """
+    Lets coroutines running in an asyncio event loop in the game thread wait for
+    things that happen in the window thread (events being queued, frames being
+    drawn, dialogs being closed) without blocking the event loop.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        _GameThread.events.listener = self.notify
+        _Window.frames_listener = self.notify
+
+    def notify(self):
+        "Called from any thread when something changed."
+        try:
+            self.loop.call_soon_threadsafe(self.changed.set)
+        except RuntimeError:
+            # the event loop was already closed
+            pass
+
+    def close(self):
+        _GameThread.events.listener = None
+        _Window.frames_listener = None
+
+    async def wait_for(self, predicate):
+        while True:
+            self.changed.clear()
+            if predicate():
+                return
+            await self.changed.wait()
+
+    def response(self):
+        """
+        Return a future, and an object with a `put` method (like a `Queue`) that can
+        be called from the window thread to set the future's result.
         """
+        future = self.loop.create_future()
 
-        check_audio_format(sound)
-        if system == 'Windows':
-            _playsoundWin(sound)
-        elif system == 'Darwin':
-            _playsoundOSX(sound)
-        else:
-            _playsoundNix(sound)
+        class Response:
+            def put(_, value):
+                self.loop.call_soon_threadsafe(
+                    lambda: future.done() or future.set_result(value)
+                )
 
-    return play_sound
+        return future, Response()
 
 class _GameThread(threading.Thread):
     instance = None
     initialized = threading.Event()
-    events = Queue()
+    events = _EventQueue()
+    input_state = _InputState()
+
+    # See record and replay
+    recorder = None
+    replayer = None
+    # See capture
+    capturer = None
+    # Last size given to resize, see draw_tilemap
+    window_size = None
+    # Set when wait returns None in headless mode, where the game would
+    # otherwise wait forever, so that the game ends as if the window was closed
+    out_of_events = False
+    # Amount of calls to loop, used to timestamp the recorded events
+    frame_index = 0
+    # In record and replay mode, the events to be returned by the next call to
+    # get_events or wait
+    pending = deque()
+    # Event types not delivered by get_events and wait (in record mode the
+    # window sends all of them anyway, see record_events)
+    unsubscribed = set()
 
     def start(self, game_main, args):
         self.game_main = game_main
@@ -248,30 +2106,55 @@ class _GameThread(threading.Thread):
 
     def run(self):
         try:
-            self.game_main(*self.args)
+            if inspect.iscoroutinefunction(self.game_main):
+                try:
+                    asyncio.run(self.game_main(*self.args))
+                finally:
+                    if self.bridge:
+                        self.bridge.close()
+            else:
+                self.game_main(*self.args)
         except Exception as e:
             sys.excepthook(*sys.exc_info())
         finally:
+            if self.recorder:
+                self.recorder.close(self.frame_index)
+            if self.capturer:
+                self.capturer.close()
+            if self.audio.mixer:
+                self.audio.mixer.close()
             self.send_command_to_tk('close', notify=True)
 
     def notify_tk(self):
         self.wait_for_tk()
-        w = _TkWindow.instance
+        w = _Window.instance
         if w:
             w.notify()
 
     def wait_for_tk(self):
-        if not _TkWindow.initialized.is_set():
+        if not _Window.initialized.is_set():
             _GameThread.initialized.set()
 
             # block until Tk is initialized
-            _TkWindow.initialized.wait()
+            _Window.initialized.wait()
 
     def send_command_to_tk(self, *args, notify=False):
-        _TkWindow.commands.put(args)
+        _Window.commands.put(args)
+        if self.capturer and args[0] in _FrameCapture.COMMANDS:
+            self.capturer.put(args)
         if notify:
             self.notify_tk()
 
+    # Draw commands issued between draw_begin and draw_end are buffered here
+    # and handed over to the Tk thread in a single command.
+    frame = None
+
+    def draw_command(self, *args):
+        if self.frame is None:
+            self.send_command_to_tk(*args)
+        else:
+            self.frame.append(args)
+
     def wait(self, event_type=None):
         """
         Wait until the next `Event`: a key is pressed/released, the mouse is moved, etc,
@@ -286,7 +2169,9 @@ class _GameThread(threading.Thread):
                         when the game is closed).
 
         Returns:
-            An `Event`, or `None` if the user closed the game window.
+            An `Event`, or `None` if the user closed the game window. In headless
+            mode there are no events, so `None` is returned and the game ends (see
+            `is_alive`).
 
         Example:
             ```
@@ -295,14 +2180,106 @@ class _GameThread(threading.Thread):
                 gamelib.say(f'You pressed {event.key}')
             ```
         """
+        self.flush_sprites(notify=False)
+        self.notify_tk()
+        w = _Window.instance
+        if not w:
+            return None
+        while True:
+            if self.pending or self.replayer:
+                event = self.next_recorded_event()
+            else:
+                try:
+                    event = _GameThread.events.get(w.interactive)
+                except Empty:
+                    # no event will ever arrive in headless mode
+                    self.out_of_events = True
+                    return None
+                if event and self.recorder:
+                    self.record_events([event])
+            if event and event.type in self.unsubscribed:
+                continue
+            if not event or not event_type or event.type == event_type:
+                return event
+
+    def next_recorded_event(self):
+        if self.pending:
+            return self.pending.popleft()
+        self.drain_events()
+        return self.replayer.next_event()
+
+    bridge = None
+
+    def async_bridge(self):
+        if not self.bridge or self.bridge.loop is not asyncio.get_running_loop():
+            if self.bridge:
+                self.bridge.close()
+            self.bridge = _AsyncBridge()
+        return self.bridge
+
+    async def wait_async(self, event_type=None):
+        """
+        Same as `wait`, but to be used with `await` in an `async` game (see `init`).
+        The other coroutines keep running while waiting for the event.
+
+        Example:
+            ```
+            async def main():
+                while gamelib.is_alive():
+                    event = await gamelib.wait_async(gamelib.EventType.KeyPress)
+                    ...
+            ```
+        """
+        bridge = self.async_bridge()
+        self.flush_sprites(notify=False)
         self.notify_tk()
-        if not _TkWindow.instance:
+        w = _Window.instance
+        if not w:
             return None
         while True:
-            event = _GameThread.events.get()
+            if self.pending or self.replayer:
+                event = self.next_recorded_event()
+            else:
+                try:
+                    event = _GameThread.events.get(False)
+                except Empty:
+                    if not w.interactive:
+                        self.out_of_events = True
+                        return None
+                    await bridge.wait_for(lambda: _GameThread.events.events)
+                    continue
+                if event and self.recorder:
+                    self.record_events([event])
+            if event and event.type in self.unsubscribed:
+                continue
             if not event or not event_type or event.type == event_type:
                 return event
 
+    async def next_frame(self, fps=30, catch_up=False):
+        """
+        Same as `loop`, but to be used with `await` in an `async` game (see `init`).
+        The other coroutines keep running while waiting for the next frame.
+
+        Example:
+            ```
+            async def main():
+                while await gamelib.next_frame(fps=30):
+                    ...
+            ```
+        """
+        bridge = self.async_bridge()
+        self.flush_sprites()
+        scheduler = self.scheduler
+        delay = scheduler.end_frame(fps, catch_up) - time.perf_counter()
+        if delay > 0 and not scheduler.uncapped:
+            await asyncio.sleep(delay)
+        # wait until draw_begin can proceed without blocking
+        limit = _Window.pipeline_depth or 1
+        await bridge.wait_for(lambda: _Window.frames_in_flight < limit or _Window.is_closed())
+        scheduler.start_frame()
+        self.next_input_frame()
+        return self.is_alive()
+
     def get_events(self):
         """
         Get the list of `Event`s that happened since the last call to `get_events`.
@@ -319,6 +2296,33 @@ class _GameThread(threading.Thread):
             ```
         """
         self.notify_tk()
+        events = list(self.pending)
+        self.pending.clear()
+        if self.replayer:
+            self.drain_events()
+            return events
+        if self.recorder:
+            if self.frame_index:
+                # the events are taken at frame boundaries, see next_input_frame
+                return events
+            return events + self.subscribed_events(self.record_events(self.drain_events()))
+        return events + self.drain_events()
+
+    def record_events(self, events):
+        """
+        In record mode, write the events taken from the window and apply them to
+        the input state, in the same order and at the same time as `replay` does.
+        """
+        self.recorder.write(self.frame_index, events)
+        for event in events:
+            self.input_state.update(event)
+        return events
+
+    def subscribed_events(self, events):
+        return [event for event in events if event.type not in self.unsubscribed]
+
+    def drain_events(self):
+        "Take all the events from the queue, up to the end of the game."
         events = []
         while True:
             try:
@@ -330,6 +2334,221 @@ class _GameThread(threading.Thread):
                 break
         return events
 
+    def record(self, path, seed=None):
+        """
+        Record all the events delivered to the game (by `get_events` or `wait`, or
+        used by `is_key_down` and the other input functions) to a file, so that the
+        game session can be reproduced later with `replay`. This can be used to
+        test a game, or to measure its performance in a repeatable way.
+
+        The `random` module is seeded with `seed` (or with a random number if `None`)
+        and the seed is saved in the file, so that random numbers are also repeated.
+
+        While recording, the events are taken from the window only at the start of
+        each frame (in `loop`), and the input state is updated at that moment, like
+        in `replay`. Events that arrive during a frame are received in the next one.
+
+        Instead of calling this function, it is also possible to set the
+        `GAMELIB_RECORD` environment variable to the path of the file.
+
+        Example:
+            ```
+            def main():
+                gamelib.record('session.rec')
+                while gamelib.loop(fps=30):
+                    ...
+            ```
+        """
+        if seed is None:
+            seed = random.randrange(2 ** 64)
+        random.seed(seed)
+        if self.recorder:
+            self.recorder.close(self.frame_index)
+        self.recorder = _Recorder(path, seed)
+
+    def replay(self, path, uncapped=False):
+        """
+        Replay a game session recorded with `record`: the events are read from the
+        file instead of the window, and delivered in the same frames as they were
+        recorded. The game is closed after the last recorded frame.
+
+        For the replay to be exact, the game must behave the same way given the same
+        events; e.g. if it uses random numbers, they must come from the `random`
+        module. Note that the frame rate does not affect the replay, since events are
+        delivered by frame number and not by time.
+
+        Instead of calling this function, it is also possible to set the
+        `GAMELIB_REPLAY` environment variable to the path of the file.
+
+        Args:
+            path: The path of the recording.
+            uncapped: If `True`, `loop` runs as fast as possible instead of waiting
+                      (e.g. to measure how long it takes to compute each frame, or
+                      to quickly play back long sessions).
+
+        Example:
+            ```
+            def main():
+                gamelib.replay('session.rec', uncapped=True)
+                while gamelib.loop(fps=30):
+                    ...
+                print(gamelib.frame_stats())
+            ```
+        """
+        self.replayer = _Replayer(path)
+        random.seed(self.replayer.seed)
+        if uncapped:
+            self.scheduler.uncapped = True
+
+    def capture(self, path, max_pending=60):
+        """
+        Save all the frames drawn by the game to a file, e.g. to make a video of the
+        game or to compare the output of the game against a known good version.
+
+        The frames are saved as lists of draw commands, compressed with gzip, in a
+        background thread. If the file cannot be written fast enough, some frames
+        are not saved instead of slowing down the game. The frames can later be
+        converted to images with `gamelib_render.py`:
+
+        ```
+        $ python3 gamelib_render.py capture.gz frames/ --format png
+        ```
+
+        Instead of calling this function, it is also possible to set the
+        `GAMELIB_CAPTURE` environment variable to the path of the file.
+
+        Args:
+            path: The path of the file.
+            max_pending: Maximum amount of frames waiting to be written.
+        """
+        if self.capturer:
+            self.capturer.close()
+        self.capturer = _FrameCapture(path, max_pending)
+
+    def subscribe(self, *event_types):
+        """
+        Start receiving events of the given `EventType`s again, after calling
+        `unsubscribe`. By default, all event types are received.
+        """
+        self.unsubscribed -= set(event_types)
+        self.send_command_to_tk('subscribe', event_types)
+
+    def unsubscribe(self, *event_types):
+        """
+        Stop receiving events of the given `EventType`s in `wait` and `get_events`.
+
+        Games that don't use some event types (e.g. `EventType.Motion`, which is
+        generated many times per second while the mouse moves) can unsubscribe from
+        them to avoid processing them at all. Key and mouse button events are still
+        processed to keep track of the input state (see `is_key_down`), and so are
+        `Motion` events once `mouse_pos` is used.
+
+        Example:
+            ```
+            gamelib.unsubscribe(gamelib.EventType.Motion)
+            ```
+        """
+        self.unsubscribed |= set(event_types)
+        self.send_command_to_tk('unsubscribe', event_types)
+
+    def configure_events(self, max_events=1000, drop_oldest=True, coalesce_motion=False):
+        """
+        Configure how events are queued until they are received by `wait` or
+        `get_events`.
+
+        Args:
+            max_events: Maximum amount of events to keep. When the game is not
+                        receiving events fast enough and this amount is reached,
+                        events are dropped.
+            drop_oldest: If `True`, the oldest events are dropped to make room for
+                         the new ones; otherwise the new events are dropped.
+            coalesce_motion: If `True`, consecutive `EventType.Motion` events are
+                             replaced by the latest one, so that only the latest mouse
+                             position is received.
+
+        The amount of events dropped so far is returned by `dropped_events`.
+        """
+        _GameThread.events.configure(max_events, drop_oldest, coalesce_motion)
+
+    def dropped_events(self):
+        """
+        Return the amount of events that were dropped because the game was not
+        receiving them fast enough (see `configure_events`).
+
+        Example:
+            ```
+            if gamelib.dropped_events():
+                print('Warning: some events were lost; call get_events() more often')
+            ```
+        """
+        return _GameThread.events.dropped
+
+    def is_key_down(self, key):
+        """
+        Return `True` if the given key is being held down.
+
+        Unlike `get_events`, this function does not consume any events. Keys are
+        identified with the same names as in `Event.key`.
+
+        Example:
+            ```
+            while gamelib.loop(fps=30):
+                if gamelib.is_key_down('Up'):
+                    player.y -= 1
+            ```
+        """
+        return key in self.input_state.keys
+
+    def is_key_pressed(self, key):
+        """
+        Return `True` if the given key was pressed during the previous frame (i.e.
+        between the last two calls to `loop`).
+        """
+        return ('key', key) in self.input_state.frame_pressed
+
+    def is_key_released(self, key):
+        """
+        Return `True` if the given key was released during the previous frame (i.e.
+        between the last two calls to `loop`).
+        """
+        return ('key', key) in self.input_state.frame_released
+
+    def is_mouse_down(self, button):
+        """
+        Return `True` if the given mouse button (see `Event.mouse_button`) is being
+        held down.
+        """
+        return button in self.input_state.buttons
+
+    def is_mouse_pressed(self, button):
+        """
+        Return `True` if the given mouse button was pressed during the previous frame
+        (i.e. between the last two calls to `loop`).
+        """
+        return ('button', button) in self.input_state.frame_pressed
+
+    def is_mouse_released(self, button):
+        """
+        Return `True` if the given mouse button was released during the previous frame
+        (i.e. between the last two calls to `loop`).
+        """
+        return ('button', button) in self.input_state.frame_released
+
+    tracking_motion = False
+
+    def mouse_pos(self):
+        """
+        Return the last known mouse position, as an `(x, y)` tuple.
+
+        Mouse motion is tracked from the first call (before that, the position is
+        only updated when a mouse button is pressed or released), so that games that
+        don't need it don't pay for it.
+        """
+        if not self.tracking_motion:
+            self.tracking_motion = True
+            self.send_command_to_tk('track_input', {EventType.Motion}, notify=True)
+        return self.input_state.mouse
+
     def title(self, s):
         """Set the window title to `s`."""
         self.send_command_to_tk('title', s)
@@ -340,45 +2559,163 @@ class _GameThread(threading.Thread):
 
         Example:
             ```
-            gamelib.icon('images/icon.gif')
+            gamelib.icon('images/icon.gif')
+            ```
+
+        Note:
+            The only image formats that are supported accross all platforms (Windows/Mac/Linux)
+            are GIF and PPM/PGM/PBM.
+        """
+        self.send_command_to_tk('icon', path)
+
+    def draw_begin(self):
+        """
+        Clear the window.
+
+        Any call to `draw_*` should be between `draw_begin` and `draw_end`.
+
+        Example:
+            ```
+            gamelib.draw_begin()
+            gamelib.draw_rectangle(0, 0, 10, 10, fill='red')
+            gamelib.draw_end()
+            ```
+        """
+        if not _Window.pipeline_depth:
+            _Window.wait_frames_in_flight(1)
+        self.frame = [('clear',)]
+        self.frame_begin = time.perf_counter()
+        self.frame_layers = False
+
+    # Layers drawn so far: layer name -> True if the layer needs to be redrawn
+    dirty_layers = {}
+
+    def layer(self, name=None, z=0):
+        """
+        Select the layer where the following `draw_*` calls will draw.
+
+        Layers are useful to avoid redrawing on each frame the parts of the screen
+        that don't change (backgrounds, boards, HUD frames): everything drawn on a
+        layer stays on the window until the layer is drawn again, even if
+        `draw_begin` is called. The default layer (`name=None`) is the only one that
+        is cleared by `draw_begin`.
+
+        The first time a layer is selected in a frame, its previous contents are
+        cleared; selecting it again in the same frame adds to what was already
+        drawn. Use `is_dirty` and `invalidate` to keep track of which layers need
+        to be redrawn.
+
+        Args:
+            name: The name of the layer, or `None` for the default layer.
+            z: Stacking order: layers with greater `z` are displayed on top of layers
+               with lower `z`. The default layer has `z=0`.
+
+        Example:
+            ```
+            gamelib.draw_begin()
+            if gamelib.is_dirty('board'):
+                gamelib.layer('board', z=-1)
+                draw_board()
+                gamelib.layer()
+            draw_pieces()
+            gamelib.draw_end()
+            ```
+        """
+        if name is not None:
+            self.dirty_layers[name] = False
+            self.frame_layers = True
+        self.draw_command('layer', name, z)
+
+    def is_dirty(self, name):
+        """
+        Return `True` if the layer called `name` has never been drawn, or if
+        `invalidate` was called after the last time it was drawn.
+        """
+        return self.dirty_layers.get(name, True)
+
+    def invalidate(self, name=None):
+        """
+        Mark the layer called `name` as needing to be redrawn (see `layer` and
+        `is_dirty`). If `name` is `None`, all layers are marked.
+        """
+        if name is None:
+            for name in self.dirty_layers:
+                self.dirty_layers[name] = True
+        else:
+            self.dirty_layers[name] = True
+
+    def draw_image(self, path, x, y, frame=None, zoom=1, subsample=1):
+        """
+        Draw an image located at `path` in the coordinates `x, y`.
+
+        Args:
+            path: Path of the image file.
+            x: The screen coordinates for the top-left corner of the image.
+            y: The screen coordinates for the top-left corner of the image.
+            frame: If the image is a sprite sheet (see `sprite_sheet`), the index of
+                   the frame to draw.
+            zoom: Draw the image `zoom` times bigger (must be an integer).
+            subsample: Draw the image `subsample` times smaller (must be an integer).
+
+        Images are loaded the first time they are drawn, and cached (see `preload`
+        and `image_cache_size`).
+
+        Example:
+            ```
+            gamelib.draw_image('images/player.gif', 10, 10)
             ```
 
         Note:
             The only image formats that are supported accross all platforms (Windows/Mac/Linux)
             are GIF and PPM/PGM/PBM.
         """
-        self.send_command_to_tk('icon', path)
+        self.draw_command('draw_image', path, x, y, frame, zoom, subsample)
 
-    def draw_begin(self):
+    def preload(self, *paths):
         """
-        Clear the window.
-
-        Any call to `draw_*` should be between `draw_begin` and `draw_end`.
+        Start loading the images located at the given paths in the background, so
+        that drawing them for the first time does not cause a hiccup.
 
         Example:
             ```
-            gamelib.draw_begin()
-            gamelib.draw_rectangle(0, 0, 10, 10, fill='red')
-            gamelib.draw_end()
+            gamelib.preload('images/player.gif', 'images/enemy.gif')
             ```
         """
-        _TkWindow.idle.wait()
-        self.send_command_to_tk('clear')
+        def load():
+            for path in paths:
+                try:
+                    with open(path, 'rb') as f:
+                        data = f.read()
+                except OSError as e:
+                    print(f"{path}: Warning: could not preload image: {e}")
+                    continue
+                _Window.commands.put(('load_image', path, data))
+
+        threading.Thread(target=load, daemon=True).start()
 
-    def draw_image(self, path, x, y):
+    def sprite_sheet(self, path, frame_width, frame_height):
         """
-        Draw an image located at `path` in the coordinates `x, y`.
+        Declare that the image located at `path` is a sprite sheet: a grid of frames of
+        `frame_width` x `frame_height` pixels each. Frames are numbered from left to
+        right and from top to bottom, starting from 0, and can be drawn with
+        `draw_image(path, x, y, frame=i)`.
 
         Example:
             ```
-            gamelib.draw_image('images/player.gif', 10, 10)
+            gamelib.sprite_sheet('images/explosion.gif', 32, 32)
+            ...
+            gamelib.draw_image('images/explosion.gif', x, y, frame=3)
             ```
+        """
+        self.send_command_to_tk('sprite_sheet', path, frame_width, frame_height)
 
-        Note:
-            The only image formats that are supported accross all platforms (Windows/Mac/Linux)
-            are GIF and PPM/PGM/PBM.
+    def image_cache_size(self, megabytes):
         """
-        self.send_command_to_tk('draw_image', path, x, y)
+        Set the approximate maximum amount of memory used by the loaded images
+        (including sprite sheet frames and zoomed variants). When exceeded, the least
+        recently used images are unloaded. The default is 64 MB.
+        """
+        self.send_command_to_tk('image_cache_size', int(megabytes * 1024 * 1024))
 
     def draw_text(self, text, x, y, font=None, size=12, bold=False, italic=False, **options):
         """
@@ -390,7 +2727,8 @@ class _GameThread(threading.Thread):
             y:    The screen coordinates for the text.
             font: Font family name (eg: `'Helvetica'`). **Note:** the only font guaranteed to be
                   available in all systems is the default font. If the selected font is not found,
-                  the default font will be used instead.
+                  the default font will be used instead. It can also be a `Font`, in which
+                  case `size`, `bold` and `italic` are ignored.
             size: Size of the text.
             bold: Whether or not to use bold weight.
             italic: Whether or not to use italic slant.
@@ -411,7 +2749,8 @@ class _GameThread(threading.Thread):
             gamelib.draw_text('Hello world!', 10, 10, fill='red', anchor='nw')
             ```
         """
-        self.send_command_to_tk('draw_text', text, x, y, font, size, bold, italic, options)
+        font = font.key if isinstance(font, Font) else (font, size, bold, italic)
+        self.draw_command('draw_text', text, x, y, font, options)
 
     def draw_arc(self, x1, y1, x2, y2, **options):
         """
@@ -426,7 +2765,7 @@ class _GameThread(threading.Thread):
             gamelib.draw_arc(10, 10, 20, 20, outline='white', fill='red')
             ```
         """
-        self.send_command_to_tk('draw', 'arc', [x1, y1, x2, y2], options)
+        self.draw_command('draw', 'arc', (x1, y1, x2, y2), options)
 
     def draw_line(self, x1, y1, x2, y2, **options):
         """
@@ -440,7 +2779,7 @@ class _GameThread(threading.Thread):
             gamelib.draw_line(10, 10, 30, 20, fill='blue', width=2)
             ```
         """
-        self.send_command_to_tk('draw', 'line', [x1, y1, x2, y2], options)
+        self.draw_command('draw', 'line', (x1, y1, x2, y2), options)
 
     def draw_oval(self, x1, y1, x2, y2, **options):
         """
@@ -454,7 +2793,7 @@ class _GameThread(threading.Thread):
             gamelib.draw_oval(10, 10, 30, 20, outline='white', fill='red')
             ```
         """
-        self.send_command_to_tk('draw', 'oval', [x1, y1, x2, y2], options)
+        self.draw_command('draw', 'oval', (x1, y1, x2, y2), options)
 
     def draw_polygon(self, points, **options):
         """
@@ -470,7 +2809,7 @@ class _GameThread(threading.Thread):
             gamelib.draw_polygon([10, 10, 30, 20, 0, 40], outline='white', fill='red')
             ```
         """
-        self.send_command_to_tk('draw', 'polygon', points, options)
+        self.draw_command('draw', 'polygon', tuple(points), options)
 
     def draw_rectangle(self, x1, y1, x2, y2, **options):
         """
@@ -484,7 +2823,140 @@ class _GameThread(threading.Thread):
             gamelib.draw_rectangle(10, 10, 30, 20, outline='white', fill='red')
             ```
         """
-        self.send_command_to_tk('draw', 'rectangle', [x1, y1, x2, y2], options)
+        self.draw_command('draw', 'rectangle', (x1, y1, x2, y2), options)
+
+    def draw_rectangles(self, coords, colors=None, **options):
+        """
+        Draw many rectangles at once. This is much faster than calling `draw_rectangle`
+        many times.
+
+        Args:
+            coords: A flat sequence of coordinates, with 4 numbers `x1, y1, x2, y2` per
+                    rectangle. It may be a list, an `array.array` or a NumPy array.
+            colors: An optional sequence with the fill color of each rectangle.
+
+        The rest of the options are the same as in `draw_rectangle`, and are applied to
+        all rectangles.
+
+        Example:
+            ```
+            gamelib.draw_rectangles([0, 0, 10, 10, 20, 20, 30, 30], colors=['red', 'blue'])
+            ```
+        """
+        self.draw_command('draw_many', 'rectangle', *_bulk_args(coords, 4, colors), options)
+
+    def draw_ovals(self, coords, colors=None, **options):
+        """
+        Draw many ellipses at once. This is much faster than calling `draw_oval`
+        many times.
+
+        `coords` is a flat sequence of coordinates, with 4 numbers `x1, y1, x2, y2` per
+        ellipse. See `draw_rectangles` for the rest of the arguments.
+
+        Example:
+            ```
+            gamelib.draw_ovals([0, 0, 10, 10, 20, 20, 30, 30], fill='yellow')
+            ```
+        """
+        self.draw_command('draw_many', 'oval', *_bulk_args(coords, 4, colors), options)
+
+    def draw_lines(self, coords, colors=None, **options):
+        """
+        Draw many straight lines at once. This is much faster than calling `draw_line`
+        many times.
+
+        `coords` is a flat sequence of coordinates, with 4 numbers `x1, y1, x2, y2` per
+        line. See `draw_rectangles` for the rest of the arguments.
+
+        Example:
+            ```
+            gamelib.draw_lines([0, 0, 10, 10, 20, 20, 30, 30], width=2)
+            ```
+        """
+        self.draw_command('draw_many', 'line', *_bulk_args(coords, 4, colors), options)
+
+    def draw_points(self, coords, colors=None, size=1, **options):
+        """
+        Draw many points at once, as squares of `size` x `size` pixels.
+
+        `coords` is a flat sequence of coordinates, with 2 numbers `x, y` per point.
+        See `draw_rectangles` for the rest of the arguments.
+
+        Example:
+            ```
+            gamelib.draw_points([10, 10, 20, 15, 30, 20], size=2, fill='green')
+            ```
+        """
+        self.draw_command('draw_points', size, *_bulk_args(coords, 2, colors), options)
+
+    def draw_framebuffer(self, framebuffer, x=0, y=0):
+        """
+        Draw a `Framebuffer` with its top-left corner at coordinates `x, y`.
+
+        Only the parts of the framebuffer that changed since the last time it was
+        drawn are sent to the window.
+
+        Example:
+            ```
+            fb = gamelib.Framebuffer(300, 300)
+            fb.set_pixel(10, 10, (255, 0, 0))
+            gamelib.draw_begin()
+            gamelib.draw_framebuffer(fb)
+            gamelib.draw_end()
+            ```
+        """
+        region = framebuffer._take_dirty_region()
+        if region:
+            # sent immediately instead of as part of the frame, so that it is
+            # not lost if the frame is dropped
+            self.send_command_to_tk('update_framebuffer', *region)
+        self.draw_command('draw_framebuffer', framebuffer.id, x, y)
+
+    def draw_tilemap(self, tilemap, camera_x=0, camera_y=0, x=0, y=0, width=None, height=None):
+        """
+        Draw the part of a `TileMap` that is visible through a viewport.
+
+        Args:
+            tilemap: The `TileMap` to draw.
+            camera_x: The map coordinates (in pixels) shown at the top-left corner
+                      of the viewport.
+            camera_y: The map coordinates (in pixels) shown at the top-left corner
+                      of the viewport.
+            x: The screen coordinates for the top-left corner of the viewport.
+            y: The screen coordinates for the top-left corner of the viewport.
+            width: Width of the viewport. By default, the width of the window.
+            height: Height of the viewport. By default, the height of the window.
+
+        Only the chunks that intersect the viewport are drawn, and they are drawn
+        whole, so the tiles at the edges may overflow the viewport. The images of
+        the chunks that were not visible in the last `TileMap.KEEP_DRAWS` calls are
+        released, so that the memory used depends on the size of the viewport and
+        not on the size of the map.
+
+        Example:
+            ```
+            gamelib.draw_tilemap(tilemap, player_x - 150, player_y - 150)
+            ```
+        """
+        if width is None or height is None:
+            self.wait_for_tk()
+            window_width, window_height = self.window_size or _Window.instance.canvas_size
+            width = window_width if width is None else width
+            height = window_height if height is None else height
+        visible = tilemap._visible_chunks(camera_x, camera_y, camera_x + width, camera_y + height)
+        for chunk, chunk_x, chunk_y in visible:
+            update = tilemap._take_chunk(chunk)
+            if update:
+                # sent immediately, see draw_framebuffer
+                self.send_command_to_tk('update_tile_chunk', *update)
+            if chunk not in tilemap._empty:
+                self.draw_command(
+                    'draw_tile_chunk', tilemap.id, chunk,
+                    x + chunk_x - camera_x, y + chunk_y - camera_y,
+                )
+        stale = tilemap._take_stale_chunks()
+        if stale:
+            self.send_command_to_tk('drop_tile_chunks', tilemap.id, stale)
 
     def draw_end(self):
         """
@@ -499,10 +2971,106 @@ class _GameThread(threading.Thread):
             gamelib.draw_end()
             ```
         """
-        self.send_command_to_tk('update', notify=True)
+        self.flush_sprites(notify=False)
+        frame = self.frame
+        self.frame = None
+        if frame is None:
+            self.send_command_to_tk('flush', notify=True)
+        else:
+            info = {
+                'frame': self.frames_sent,
+                'fps': self.scheduler.fps(30),
+                'frame_time': self.scheduler.frame_times[-1] if self.scheduler.frame_times else 0.0,
+                'build_time': time.perf_counter() - self.frame_begin,
+                'commands': len(frame) - 1,
+                'layers': self.frame_layers,
+            }
+            frame.append(('flush',))
+            self.frames_sent += 1
+            self.report_frame_stats()
+            _Window.wait_frames_in_flight(max(1, _Window.pipeline_depth), reserve=True)
+            info['submitted'] = time.perf_counter()
+            self.send_command_to_tk('draw_frame', frame, info, notify=True)
+
+    frames_sent = 0
+    frame_stats_callback = None
+
+    # Sprite changes made since the last frame: sprite id -> changed attributes
+    sprite_updates = {}
+
+    def flush_sprites(self, notify=True):
+        if self.sprite_updates:
+            self.send_command_to_tk('update_sprites', self.sprite_updates, notify=notify)
+            self.sprite_updates = {}
+
+    def report_frame_stats(self):
+        callback = self.frame_stats_callback
+        infos = _Window.frame_infos
+        while callback and infos:
+            callback(infos.popleft())
+
+    def on_frame_stats(self, callback):
+        """
+        Register a function to be called with performance information about each
+        frame drawn on the window, or `None` to unregister it.
+
+        The function is called from `draw_end`, some time after the frame was drawn,
+        and receives a dictionary with the following keys (all times in seconds):
+
+        * `frame`: Frame number.
+        * `fps`: Frames per second measured by `loop`.
+        * `frame_time`: Time spent between the last two calls to `loop`.
+        * `build_time`: Time spent between `draw_begin` and `draw_end`.
+        * `commands`: Amount of `draw_*` calls in the frame.
+        * `queue_wait`: Time that the frame waited before the window started drawing it.
+        * `render_time`: Time that the window spent drawing the frame.
+        * `items`: Amount of items displayed in the window.
+        * `dropped`: Amount of frames dropped so far (see `pipeline`).
+
+        Example:
+            ```
+            def log_slow_frames(info):
+                if info['render_time'] > 0.01:
+                    print(info)
+
+            gamelib.on_frame_stats(log_slow_frames)
+            ```
+        """
+        self.frame_stats_callback = callback
+        _Window.frame_infos.clear()
+
+    def show_stats(self, show=True):
+        """
+        Show or hide an overlay with live performance information on the window
+        (see `on_frame_stats`). The overlay can also be toggled by pressing F12.
+        """
+        self.send_command_to_tk('show_stats', show)
+
+    def pipeline(self, depth=2):
+        """
+        Let the game prepare the next frames while the previous ones are still being
+        drawn on the window.
+
+        By default `draw_begin` waits until the previous frame is displayed. After
+        calling `pipeline`, the game thread keeps running and up to `depth` frames may
+        be queued for drawing; if the window falls behind, only the most recent
+        frame is drawn and the stale ones are dropped. Call `pipeline(0)` to restore
+        the default behavior.
+
+        Example:
+            ```
+            gamelib.pipeline(2)
+            while gamelib.loop(fps=60):
+                gamelib.draw_begin()
+                ...
+                gamelib.draw_end()
+            ```
+        """
+        _Window.pipeline_depth = depth
 
     def resize(self, w, h):
         """Resize the window to be `w` pixels wide and `h` pixels tall."""
+        self.window_size = (w, h)
         self.send_command_to_tk('resize', w, h)
 
     def say(self, message):
@@ -526,6 +3094,24 @@ class _GameThread(threading.Thread):
         self.send_command_to_tk('input', prompt, response, notify=True)
         return response.get()
 
+    async def say_async(self, message):
+        """
+        Same as `say`, but to be used with `await` in an `async` game (see `init`).
+        The other coroutines keep running while the dialog box is displayed.
+        """
+        future, done = self.async_bridge().response()
+        self.send_command_to_tk('say', message, done, notify=True)
+        await future
+
+    async def input_async(self, prompt):
+        """
+        Same as `input`, but to be used with `await` in an `async` game (see `init`).
+        The other coroutines keep running while the dialog box is displayed.
+        """
+        future, response = self.async_bridge().response()
+        self.send_command_to_tk('input', prompt, response, notify=True)
+        return await future
+
     def is_alive(self):
         """
         Returns True if the game window is open.
@@ -538,14 +3124,26 @@ class _GameThread(threading.Thread):
             ```
         """
         self.wait_for_tk()
-        return bool(_TkWindow.instance)
+        if self.replayer and self.replayer.finished:
+            return False
+        if self.out_of_events:
+            return False
+        return bool(_Window.instance)
 
-    _last_loop_time = None
+    scheduler = _FrameScheduler()
 
-    def loop(self, fps=30):
+    def loop(self, fps=30, catch_up=False):
         """
         When used in a `while` loop, the body will be executed `fps` times per second.
 
+        Args:
+            fps: Frames per second.
+            catch_up: What to do when a frame takes longer than `1 / fps` seconds.
+                      If `False`, the late frames are skipped and the game continues at
+                      the normal pace from that point. If `True`, the following frames
+                      run without waiting until the game catches up with the schedule,
+                      so that the average frame rate is exactly `fps`.
+
         Returns:
             `True` if the game window is still open, `False` otherwise.
 
@@ -558,71 +3156,360 @@ class _GameThread(threading.Thread):
                         return
             ```
         """
-        frame_duration = 1.0 / fps
-        a = _GameThread._last_loop_time
-        b = time.time()
-        if a:
-            time.sleep(max(0, frame_duration - (b - a)))
-        _GameThread._last_loop_time = time.time()
+        self.flush_sprites()
+        self.scheduler.wait(fps, catch_up)
+        self.next_input_frame()
         return self.is_alive()
 
+    def next_input_frame(self):
+        self.frame_index += 1
+        if self.replayer:
+            self.drain_events()
+            self.pending.extend(self.subscribed_events(self.replayer.frame_events(self.frame_index)))
+        elif self.recorder:
+            # Record all the events that arrived during the last frame, even if
+            # the game does not read them (e.g. if it uses is_key_down instead),
+            # so that the input state can be reconstructed in replay mode.
+            events = self.record_events(self.drain_events())
+            self.pending.extend(self.subscribed_events(events))
+            while len(self.pending) > self.events.max_events:
+                self.pending.popleft()
+                self.events.dropped += 1
+        self.input_state.next_frame()
+        mixer = self.audio.mixer
+        if mixer:
+            scheduler = self.scheduler
+            mixer.on_frame(scheduler.frame_start, 1 / scheduler.frame_duration, scheduler.uncapped)
+
+    def fixed_loop(self, update, render, tps=60, fps=30, max_ticks=5):
+        """
+        Run the game with a fixed simulation rate, independent of the frame rate.
+
+        `update(dt)` is called `tps` times per second, with `dt = 1 / tps`: when a frame
+        is late it is called as many times as needed to catch up (up to `max_ticks` times
+        per frame, after which the simulation slows down instead of freezing the game).
+        `render(alpha)` is called once per displayed frame, `fps` times per second.
+        `alpha` is a number between 0 and 1 indicating how far the current time is
+        between the last `update` and the next one, and can be used to interpolate
+        positions for smoother movement.
+
+        The function returns when the game window is closed, or when `update`
+        returns `False`.
+
+        Example:
+            ```
+            def update(dt):
+                for event in gamelib.get_events():
+                    if event.type == gamelib.EventType.KeyPress and event.key == 'q':
+                        return False
+                ball.x += ball.speed * dt
+
+            def render(alpha):
+                gamelib.draw_begin()
+                gamelib.draw_oval(ball.x - 5, ball.y - 5, ball.x + 5, ball.y + 5)
+                gamelib.draw_end()
+
+            gamelib.fixed_loop(update, render, tps=60, fps=30)
+            ```
+        """
+        dt = 1.0 / tps
+        accumulator = 0.0
+        while self.loop(fps):
+            accumulator += self.scheduler.interval
+            ticks = 0
+            while accumulator >= dt:
+                if ticks == max_ticks:
+                    accumulator = 0.0
+                    break
+                if update(dt) is False:
+                    return
+                accumulator -= dt
+                ticks += 1
+            render(accumulator / dt)
+
+    def frame_stats(self):
+        """
+        Get statistics about the last frames executed by `loop`.
+
+        Returns:
+            A dictionary with the following keys:
+
+            * `frames`: Amount of frames executed so far.
+            * `missed`: Amount of frames that took longer than `1 / fps` seconds.
+            * `fps`: Measured frames per second.
+            * `min`, `avg`, `p99`, `max`: Minimum, average, 99th percentile and maximum
+              time in seconds spent in each frame (i.e. between two calls to `loop`).
+
+        Example:
+            ```
+            while gamelib.loop(fps=30):
+                ...
+            print(gamelib.frame_stats())
+            ```
+        """
+        return self.scheduler.stats()
+
+    audio = _AudioEngine()
+
+    def play_sound(self, sound, volume=1.0, delay=0):
+        """
+        Play a sound located at the given path.
+
+        The function returns immediately: the sound is loaded and played in the
+        background. Sounds are cached, so playing the same sound many times (e.g. a
+        bounce effect) is cheap. If too many sounds are playing at the same time
+        (see `max_sounds`), the oldest one is stopped.
+
+        Args:
+            sound: The path of the sound.
+            volume: A number between 0 and 1.
+            delay: Play the sound this many frames (of `loop`) from now.
+
+        `volume` and `delay` need the software mixer, which is started automatically
+        when they are used (see `mixer`). If the mixer is not available on this
+        platform, they are ignored.
+
+        Example:
+            ```
+            gamelib.play_sound('sound/jump.wav')
+            ```
+
+        Note:
+            The only sound format that is supported accross all platforms (Windows/Mac/Linux)
+            is WAV.
+        """
+        check_audio_format(sound)
+        mixer = self.audio.mixer
+        if not mixer and (volume != 1 or delay):
+            mixer = self.audio.get_mixer()
+            if not mixer:
+                self.audio.warn('the volume and delay of sounds are ignored')
+        if mixer:
+            mixer.play(sound, volume, delay)
+        else:
+            self.audio.request('play', sound)
+
+    def preload_sounds(self, *paths):
+        """
+        Load the given sounds in the background, so that they start playing without
+        delay the first time `play_sound` is called.
+
+        With the software mixer (see `mixer`), the sounds are decoded in memory.
+        Otherwise, each sound is opened in a voice that is not in use yet, so at most
+        `max_sounds` sounds are ready to play at the same time.
+        """
+        for path in paths:
+            check_audio_format(path)
+            self.audio.request('preload', path)
+
+    def stop_sounds(self):
+        "Stop all the sounds that are playing (except the music, see `stop_music`)."
+        if self.audio.mixer:
+            self.audio.mixer.stop()
+        self.audio.request('stop_all')
+
+    def max_sounds(self, n):
+        """
+        Set the maximum amount of sounds that can be played at the same time (default: 8).
+        If more sounds are playing, the oldest ones are stopped.
+        """
+        self.audio.request('set_max_voices', n)
+        if self.audio.mixer:
+            self.audio.mixer.set_max_channels(n)
+
+    def mixer(self, sink=None, rate=22050):
+        """
+        Start the software mixer. From then on, all the sounds are mixed by gamelib
+        and sent to the sound card as a single stream, which allows playing music
+        (see `play_music`), changing the volume of each sound and scheduling sounds
+        at exact frames (see `play_sound`).
+
+        There is no need to call this function unless you want to change the output:
+        the mixer is started automatically when needed.
+
+        Args:
+            sink: Where to send the mixed audio: `'platform'` for the sound card
+                  (currently only supported on Linux, with GStreamer), `'null'` to
+                  discard it, the path of a WAV file to save it, or an object with
+                  `write(data)` and `close()` methods, that receives 16 bit stereo
+                  samples. If `None`, the sound card is used, unless in headless
+                  mode or if the `GAMELIB_AUDIO` environment variable is `null`.
+            rate: Sample rate in Hz.
+
+        Example:
+            ```
+            # save the game audio to a file (e.g. together with gamelib.capture())
+            gamelib.mixer('game.wav')
+            ```
+        """
+        self.audio.start_mixer(sink, rate)
+
+    def play_music(self, path, volume=1.0, loop=True):
+        """
+        Play music in the background, replacing the music that was playing, if any.
+
+        The file is read in small chunks while it is played, so it can be long.
+        The music is not affected by `stop_sounds` or `max_sounds`.
+
+        Args:
+            path: The path of a WAV file.
+            volume: A number between 0 and 1.
+            loop: If `True`, the music is repeated forever.
+
+        Example:
+            ```
+            gamelib.play_music('sound/theme.wav', volume=0.5)
+            ```
+        """
+        check_audio_format(path)
+        mixer = self.audio.get_mixer()
+        if mixer:
+            mixer.play(path, volume, loop=loop, music=True)
+        else:
+            self.audio.warn('music is disabled')
+
+    def stop_music(self):
+        "Stop the music started with `play_music`."
+        if self.audio.mixer:
+            self.audio.mixer.stop(music=True)
+
+    def music_volume(self, volume):
+        "Change the volume of the music (a number between 0 and 1)."
+        if self.audio.mixer:
+            self.audio.mixer.set_music_volume(volume)
+
 _GameThread.instance = _GameThread()
 
 wait = _GameThread.instance.wait
+wait_async = _GameThread.instance.wait_async
+next_frame = _GameThread.instance.next_frame
+say_async = _GameThread.instance.say_async
+input_async = _GameThread.instance.input_async
 get_events = _GameThread.instance.get_events
+subscribe = _GameThread.instance.subscribe
+unsubscribe = _GameThread.instance.unsubscribe
+configure_events = _GameThread.instance.configure_events
+dropped_events = _GameThread.instance.dropped_events
+is_key_down = _GameThread.instance.is_key_down
+is_key_pressed = _GameThread.instance.is_key_pressed
+is_key_released = _GameThread.instance.is_key_released
+is_mouse_down = _GameThread.instance.is_mouse_down
+is_mouse_pressed = _GameThread.instance.is_mouse_pressed
+is_mouse_released = _GameThread.instance.is_mouse_released
+mouse_pos = _GameThread.instance.mouse_pos
+record = _GameThread.instance.record
+replay = _GameThread.instance.replay
+capture = _GameThread.instance.capture
 title = _GameThread.instance.title
 icon = _GameThread.instance.icon
 draw_begin = _GameThread.instance.draw_begin
+layer = _GameThread.instance.layer
+is_dirty = _GameThread.instance.is_dirty
+invalidate = _GameThread.instance.invalidate
 draw_image = _GameThread.instance.draw_image
+preload = _GameThread.instance.preload
+sprite_sheet = _GameThread.instance.sprite_sheet
+image_cache_size = _GameThread.instance.image_cache_size
 draw_text = _GameThread.instance.draw_text
 draw_arc = _GameThread.instance.draw_arc
 draw_line = _GameThread.instance.draw_line
 draw_oval = _GameThread.instance.draw_oval
 draw_polygon = _GameThread.instance.draw_polygon
 draw_rectangle = _GameThread.instance.draw_rectangle
+draw_rectangles = _GameThread.instance.draw_rectangles
+draw_ovals = _GameThread.instance.draw_ovals
+draw_lines = _GameThread.instance.draw_lines
+draw_points = _GameThread.instance.draw_points
+draw_framebuffer = _GameThread.instance.draw_framebuffer
+draw_tilemap = _GameThread.instance.draw_tilemap
 draw_end = _GameThread.instance.draw_end
 resize = _GameThread.instance.resize
+pipeline = _GameThread.instance.pipeline
 say = _GameThread.instance.say
 input = _GameThread.instance.input
 is_alive = _GameThread.instance.is_alive
 loop = _GameThread.instance.loop
-play_sound = _audio_init()
+fixed_loop = _GameThread.instance.fixed_loop
+frame_stats = _GameThread.instance.frame_stats
+on_frame_stats = _GameThread.instance.on_frame_stats
+show_stats = _GameThread.instance.show_stats
+play_sound = _GameThread.instance.play_sound
+preload_sounds = _GameThread.instance.preload_sounds
+stop_sounds = _GameThread.instance.stop_sounds
+max_sounds = _GameThread.instance.max_sounds
+mixer = _GameThread.instance.mixer
+play_music = _GameThread.instance.play_music
+stop_music = _GameThread.instance.stop_music
+music_volume = _GameThread.instance.music_volume
 
 def _sigint_handler(sig, frame):
-    w = _TkWindow.instance
+    w = _Window.instance
     if w:
         w.close()
     else:
         raise KeyboardInterrupt()
 
-def init(game_main, args=None):
+def init(game_main, args=None, headless=None):
     """
     Initialize gamelib.
 
     Args:
-        game_main: Your `main` function.
+        game_main: Your `main` function. It can also be a coroutine function (i.e.
+                   `async def main()`), in which case it is run in an `asyncio` event
+                   loop, and can use `next_frame`, `wait_async`, `say_async` and
+                   `input_async` to let other coroutines run while waiting.
         args: List of arguments to be passed to the `main` function, or `None`.
+        headless: If `True`, run the game without a window (e.g. in a server without
+                  a display). All the drawing functions are accepted but nothing is
+                  displayed, there is no user input (`wait` returns `None`), and `loop`
+                  runs as fast as possible instead of waiting, and sounds are not
+                  played. If `None`, headless mode is enabled when the
+                  `GAMELIB_HEADLESS` environment variable is set to a value other
+                  than `0`.
+
+    If the `GAMELIB_RECORD` or `GAMELIB_REPLAY` environment variables are set, the
+    game session is recorded to or replayed from the given file (see `record` and
+    `replay`). When replaying, set `GAMELIB_UNCAPPED=1` to run as fast as possible.
+    If `GAMELIB_CAPTURE` is set, the frames are saved to the given file (see
+    `capture`). Set `GAMELIB_AUDIO=null` to disable sounds.
     """
+    if headless is None:
+        headless = os.environ.get('GAMELIB_HEADLESS', '0') not in ('', '0')
+    _GameThread.scheduler.uncapped = headless
+    if headless:
+        _GameThread.audio.backend_name = 'null'
+    if os.environ.get('GAMELIB_RECORD'):
+        _GameThread.instance.record(os.environ['GAMELIB_RECORD'])
+    if os.environ.get('GAMELIB_REPLAY'):
+        _GameThread.instance.replay(
+            os.environ['GAMELIB_REPLAY'],
+            uncapped=os.environ.get('GAMELIB_UNCAPPED', '0') not in ('', '0'),
+        )
+    if os.environ.get('GAMELIB_CAPTURE'):
+        _GameThread.instance.capture(os.environ['GAMELIB_CAPTURE'])
+
     _GameThread.instance.start(game_main, args or [])
 
     # block until wait(), get_events(), etc called on game thread.
     # This prevents rendering the window before the user has a chance to configure it.
     _GameThread.initialized.wait()
 
-    _TkWindow.instance = _TkWindow()
-    _TkWindow.initialized.set()
+    _Window.instance = _HeadlessWindow() if headless else _TkWindow()
+    _Window.initialized.set()
 
     signal.signal(signal.SIGINT, _sigint_handler)
 
     try:
-        _TkWindow.instance.mainloop()
+        _Window.instance.mainloop()
     finally:
         _GameThread.events.put(None)
-        _TkWindow.instance = None
+        _Window.instance = None
         _GameThread.instance.join(1)
         if _GameThread.instance.is_alive():
             print('Killing unresponsive game thread. Make sure to call get_events() or wait() periodically.')
             os._exit(1)
+        if _GameThread.instance.capturer:
+            _GameThread.instance.capturer.join()
         os._exit(0)
 
 class EventType(Enum):
@@ -650,26 +3537,554 @@ class Event:
         x: The current mouse horizontal position, in pixels.
         y: The current mouse vertical position, in pixels.
 
-    This is actually a wrapper for the
-    [Tkinter Event class](https://anzeljg.github.io/rin2/book2/2405/docs/tkinter/event-handlers.html).
-    Any of the `tk.Event` attributes can be accessed through this object.
+    The fields are copied from the
+    [Tkinter Event](https://anzeljg.github.io/rin2/book2/2405/docs/tkinter/event-handlers.html)
+    when the event is generated. For compatibility, the `tk.Event` attributes `keysym`,
+    `num`, `char`, `keycode`, `state`, `time`, `x_root`, `y_root`, `delta`, `width` and
+    `height` can also be accessed through this object.
 
     ## See also
 
     `wait`, `get_events`
     """
 
-    def __init__(self, tkevent):
-        self.tkevent = tkevent
+    __slots__ = ('type', 'key', 'mouse_button', 'x', 'y', 'raw')
+
+    # Attributes of tk.Event stored in `raw`
+    RAW_ATTRIBUTES = ('char', 'keycode', 'state', 'time', 'x_root', 'y_root', 'delta', 'width', 'height')
+
+    def __init__(self, type, key=None, mouse_button=None, x=0, y=0, raw=None):
+        self.type = type
+        self.key = key
+        self.mouse_button = mouse_button
+        self.x = x
+        self.y = y
+        self.raw = raw
+
+    @classmethod
+    def from_tk(cls, tkevent):
+        "Create an `Event` from a `tk.Event`."
+        return cls(
+            _TK_EVENT_TYPES.get(tkevent.type) or EventType[tkevent.type.name],
+            tkevent.keysym,
+            tkevent.num,
+            tkevent.x,
+            tkevent.y,
+            tuple(getattr(tkevent, k, None) for k in cls.RAW_ATTRIBUTES),
+        )
 
     def __getattr__(self, k):
-        if k == 'type': return EventType[self.tkevent.type.name]
-        if k == 'key': return self.tkevent.keysym
-        if k == 'mouse_button': return self.tkevent.num
-        return getattr(self.tkevent, k)
+        if k == 'keysym': return self.key
+        if k == 'num': return self.mouse_button
+        if k in Event.RAW_ATTRIBUTES:
+            return self.raw[Event.RAW_ATTRIBUTES.index(k)] if self.raw else None
+        raise AttributeError(k)
+
+    def __repr__(self):
+        return f'<{self.type.name} event key={self.key!r} mouse_button={self.mouse_button!r} x={self.x} y={self.y}>'
+
+_TK_EVENT_TYPES = {getattr(tk.EventType, t.name): t for t in EventType}
+
+class Framebuffer:
+    """
+    A rectangular buffer of pixels that can be modified freely and then drawn with
+    `draw_framebuffer`. This is much faster than drawing individual rectangles when
+    drawing many pixels (e.g. for cellular automata, raycasters or plasma effects).
+
+    Attributes:
+        width: Width in pixels.
+        height: Height in pixels.
+        pixels: A `bytearray` containing the pixels in row-major order, 3 bytes (red,
+                green, blue) per pixel. If you modify it directly, call `invalidate` so
+                that the changes are displayed. With NumPy, it can be accessed as
+                `numpy.frombuffer(fb.pixels, dtype=numpy.uint8).reshape(fb.height, fb.width, 3)`.
+
+    Colors can be given as `(r, g, b)` tuples with values between 0 and 255, or
+    as strings in `'#rrggbb'` format.
+
+    Example:
+        ```
+        fb = gamelib.Framebuffer(300, 300)
+        x = 0
+        while gamelib.loop(fps=30):
+            for y in range(300):
+                fb.set_pixel(x, y, (255, 0, 0))
+            x = (x + 1) % 300
+            gamelib.draw_begin()
+            gamelib.draw_framebuffer(fb)
+            gamelib.draw_end()
+        ```
+    """
+
+    _ids = itertools.count()
+
+    def __init__(self, width, height, color=(0, 0, 0)):
+        self.id = next(Framebuffer._ids)
+        self.width = width
+        self.height = height
+        self.pixels = bytearray(bytes(_rgb(color)) * (width * height))
+        self._dirty = None
+        self.invalidate()
+
+    def set_pixel(self, x, y, color):
+        "Set the color of the pixel at `x, y`. Raises `IndexError` if out of bounds."
+        i = self._index(x, y)
+        self.pixels[i:i + 3] = bytes(_rgb(color))
+        self.invalidate(x, y, 1, 1)
+
+    def get_pixel(self, x, y):
+        "Get the color of the pixel at `x, y` as an `(r, g, b)` tuple. Raises `IndexError` if out of bounds."
+        i = self._index(x, y)
+        return tuple(self.pixels[i:i + 3])
+
+    def _index(self, x, y):
+        if not (0 <= x < self.width and 0 <= y < self.height):
+            raise IndexError(f'pixel {x}, {y} is outside of the {self.width}x{self.height} framebuffer')
+        return (y * self.width + x) * 3
+
+    def fill(self, color, x=0, y=0, w=None, h=None):
+        """
+        Fill a rectangle of `w` x `h` pixels with its top-left corner at `x, y` with the
+        given color. By default, the whole framebuffer is filled.
+        """
+        x1, y1 = max(0, x), max(0, y)
+        x2 = self.width if w is None else min(self.width, x + w)
+        y2 = self.height if h is None else min(self.height, y + h)
+        if x1 >= x2 or y1 >= y2:
+            return
+        row = bytes(_rgb(color)) * (x2 - x1)
+        stride = self.width * 3
+        for yy in range(y1, y2):
+            i = yy * stride + x1 * 3
+            self.pixels[i:i + len(row)] = row
+        self.invalidate(x1, y1, x2 - x1, y2 - y1)
+
+    def invalidate(self, x=0, y=0, w=None, h=None):
+        """
+        Mark a rectangle of `w` x `h` pixels with its top-left corner at `x, y` as
+        modified, so that it is sent to the window the next time the framebuffer is
+        drawn. By default, the whole framebuffer is marked as modified.
+        """
+        x2 = self.width if w is None else x + w
+        y2 = self.height if h is None else y + h
+        if self._dirty:
+            dx1, dy1, dx2, dy2 = self._dirty
+            x, y, x2, y2 = min(x, dx1), min(y, dy1), max(x2, dx2), max(y2, dy2)
+        self._dirty = (x, y, x2, y2)
+
+    def _take_dirty_region(self):
+        """
+        Return the arguments for the window's `update_framebuffer` command with a
+        copy of the modified region in PPM format, or `None` if nothing changed.
+        """
+        if not self._dirty:
+            return None
+        x1, y1, x2, y2 = self._dirty
+        self._dirty = None
+        stride = self.width * 3
+        if x1 == 0 and x2 == self.width:
+            body = self.pixels[y1 * stride:y2 * stride]
+        else:
+            body = b''.join(self.pixels[y * stride + x1 * 3:y * stride + x2 * 3] for y in range(y1, y2))
+        data = f'P6 {x2 - x1} {y2 - y1} 255\n'.encode() + body
+        return self.id, self.width, self.height, x1, y1, data
+
+class TileMap:
+    """
+    A grid of tiles taken from an atlas image, drawn with `draw_tilemap`. This is
+    much faster than drawing each tile with `draw_image`, especially for maps that
+    are larger than the window.
+
+    The map is split in square chunks of `chunk_size` x `chunk_size` tiles. Each
+    chunk is composited into a single image the first time it is visible, and the
+    image is reused until one of its tiles changes. Only the chunks that intersect
+    the viewport are drawn.
+
+    Args:
+        columns: Width of the map, in tiles.
+        rows: Height of the map, in tiles.
+        tile_width: Width of each tile, in pixels.
+        tile_height: Height of each tile, in pixels.
+        atlas: Path of the image containing the tiles: a grid of `tile_width` x
+               `tile_height` tiles, numbered from left to right and from top to
+               bottom, starting from 0 (as in `sprite_sheet`).
+        fill: The initial tile. Negative numbers mean no tile (transparent).
+        chunk_size: Width and height of the chunks, in tiles.
+
+    Attributes:
+        width: Width of the map, in pixels.
+        height: Height of the map, in pixels.
+        tiles: An `array.array` with the tile numbers in row-major order. If you
+               modify it directly, call `invalidate` so that the changes are
+               displayed.
+
+    Example:
+        ```
+        tilemap = gamelib.TileMap(200, 200, 16, 16, 'images/tiles.gif', fill=0)
+        tilemap.set(10, 5, 3)
+        camera_x = 0
+        while gamelib.loop(fps=30):
+            camera_x += 2
+            gamelib.draw_begin()
+            gamelib.draw_tilemap(tilemap, camera_x, 0)
+            gamelib.draw_end()
+        ```
+    """
+
+    _ids = itertools.count()
+
+    # Chunks that are not visible in this many calls to draw_tilemap are released
+    KEEP_DRAWS = 60
+
+    def __init__(self, columns, rows, tile_width, tile_height, atlas, fill=-1, chunk_size=16):
+        self.id = next(TileMap._ids)
+        self.columns = columns
+        self.rows = rows
+        self.tile_width = tile_width
+        self.tile_height = tile_height
+        self.width = columns * tile_width
+        self.height = rows * tile_height
+        self.atlas = atlas
+        self.chunk_size = chunk_size
+        self.chunk_columns = -(-columns // chunk_size)
+        self.chunk_rows = -(-rows // chunk_size)
+        self.tiles = array('h', [fill]) * (columns * rows)
+        # chunks that need to be composited again, and chunks without tiles
+        self._dirty = set()
+        self._empty = set()
+        # chunks composited by the window -> the last draw in which they were visible
+        self._drawn = {}
+        self._draws = 0
+        self.invalidate()
+
+    def get(self, column, row):
+        "Get the tile at `column, row`."
+        return self.tiles[row * self.columns + column]
+
+    def set(self, column, row, tile):
+        "Set the tile at `column, row`."
+        i = row * self.columns + column
+        if self.tiles[i] != tile:
+            self.tiles[i] = tile
+            self._dirty.add((column // self.chunk_size, row // self.chunk_size))
+
+    def fill(self, tile, column=0, row=0, columns=None, rows=None):
+        """
+        Fill a rectangle of `columns` x `rows` tiles with its top-left corner at
+        `column, row` with the given tile. By default, the whole map is filled.
+        """
+        c1, r1 = max(0, column), max(0, row)
+        c2 = self.columns if columns is None else min(self.columns, column + columns)
+        r2 = self.rows if rows is None else min(self.rows, row + rows)
+        if c1 >= c2 or r1 >= r2:
+            return
+        span = array('h', [tile]) * (c2 - c1)
+        for r in range(r1, r2):
+            i = r * self.columns
+            self.tiles[i + c1:i + c2] = span
+        self.invalidate(c1, r1, c2 - c1, r2 - r1)
+
+    def invalidate(self, column=0, row=0, columns=None, rows=None):
+        """
+        Mark a rectangle of `columns` x `rows` tiles with its top-left corner at
+        `column, row` as modified, so that it is sent to the window the next time it
+        is visible. By default, the whole map is marked as modified.
+        """
+        c2 = self.columns if columns is None else column + columns
+        r2 = self.rows if rows is None else row + rows
+        n = self.chunk_size
+        for cy in range(max(0, row) // n, min(self.rows, r2 - 1) // n + 1):
+            for cx in range(max(0, column) // n, min(self.columns, c2 - 1) // n + 1):
+                self._dirty.add((cx, cy))
+
+    def tile_at(self, x, y):
+        """
+        Return the `(column, row)` of the tile at the map coordinates `x, y` (in
+        pixels), or `None` if the point is outside of the map.
+        """
+        column, row = int(x // self.tile_width), int(y // self.tile_height)
+        if 0 <= column < self.columns and 0 <= row < self.rows:
+            return column, row
+        return None
+
+    def _visible_chunks(self, x1, y1, x2, y2):
+        "Generate the chunks that intersect the rectangle between `x1, y1` and `x2, y2` (in pixels)"
+        self._draws += 1
+        w = self.chunk_size * self.tile_width
+        h = self.chunk_size * self.tile_height
+        cx1, cx2 = max(0, int(x1 // w)), min(self.chunk_columns - 1, int((x2 - 1) // w))
+        cy1, cy2 = max(0, int(y1 // h)), min(self.chunk_rows - 1, int((y2 - 1) // h))
+        for cy in range(cy1, cy2 + 1):
+            for cx in range(cx1, cx2 + 1):
+                self._drawn[cx, cy] = self._draws
+                yield (cx, cy), cx * w, cy * h
+
+    def _take_stale_chunks(self):
+        "Return the chunks that were not visible recently, so that the window can release them."
+        if self._draws % self.KEEP_DRAWS:
+            return None
+        oldest = self._draws - self.KEEP_DRAWS
+        stale = [chunk for chunk, draw in self._drawn.items() if draw <= oldest]
+        for chunk in stale:
+            del self._drawn[chunk]
+            if chunk not in self._empty:
+                self._dirty.add(chunk)
+        return stale
+
+    def _take_chunk(self, chunk):
+        """
+        Return the arguments for the window's `update_tile_chunk` command if the
+        chunk was modified, or `None` otherwise.
+        """
+        if chunk not in self._dirty:
+            return None
+        self._dirty.discard(chunk)
+        cx, cy = chunk
+        n = self.chunk_size
+        c1, r1 = cx * n, cy * n
+        c2, r2 = min(self.columns, c1 + n), min(self.rows, r1 + n)
+        tiles = array('h')
+        for r in range(r1, r2):
+            i = r * self.columns
+            tiles += self.tiles[i + c1:i + c2]
+        if max(tiles) < 0:
+            self._empty.add(chunk)
+            return None
+        self._empty.discard(chunk)
+        return (
+            self.id, chunk, self.atlas,
+            (self.tile_width, self.tile_height), (c2 - c1, r2 - r1), tiles,
+        )
+
+class _Persistent:
+    """
+    Base class for objects that stay on the window until they are destroyed (see
+    `Sprite` and `Text`). Only the changes are sent to the window.
+    """
+
+    _ids = itertools.count()
+
+    def __init__(self, x, y, z, visible):
+        self.id = next(_Persistent._ids)
+        self.x = x
+        self.y = y
+        self.z = z
+        self.visible = visible
+        self.destroyed = False
+
+    def _update(self, **changes):
+        if not self.destroyed:
+            _GameThread.instance.sprite_updates.setdefault(self.id, {}).update(changes)
+
+    def move_to(self, x, y):
+        "Move the object to `x, y`."
+        self.x, self.y = x, y
+        self._update(pos=(x, y))
+
+    def move(self, dx, dy):
+        "Move the object `dx` pixels horizontally and `dy` pixels vertically."
+        self.move_to(self.x + dx, self.y + dy)
+
+    def set_z(self, z):
+        "Change the stacking order of the object."
+        self.z = z
+        self._update(z=z)
+
+    def show(self):
+        "Make the object visible."
+        self.visible = True
+        self._update(visible=True)
+
+    def hide(self):
+        "Make the object invisible."
+        self.visible = False
+        self._update(visible=False)
+
+    def destroy(self):
+        "Remove the object from the window. After this, the other methods do nothing."
+        self.destroyed = True
+        _GameThread.instance.sprite_updates[self.id] = {'destroy': True}
+
+class Sprite(_Persistent):
+    """
+    An image that stays on the window until it is destroyed, and that can be moved,
+    hidden or animated cheaply.
+
+    Unlike `draw_image`, sprites don't need to be drawn again on each frame between
+    `draw_begin` and `draw_end`: only the changes are sent to the window (in the next
+    call to `loop`, `draw_end` or `wait`). Sprites are always displayed on top of
+    anything drawn with the `draw_*` functions.
+
+    Args:
+        path: Path of the image file.
+        x: The screen coordinates for the top-left corner of the image.
+        y: The screen coordinates for the top-left corner of the image.
+        frame: If the image is a sprite sheet (see `sprite_sheet`), the index of the
+               frame to display.
+        z: Stacking order: sprites with greater `z` are displayed on top of sprites with
+           lower `z`.
+        visible: Whether the sprite is visible or not.
+
+    The arguments are also available as (read-only) attributes.
+
+    Example:
+        ```
+        player = gamelib.Sprite('images/player.gif', 10, 10)
+        while gamelib.loop(fps=30):
+            player.move(1, 0)
+        ```
+    """
+
+    def __init__(self, path, x=0, y=0, frame=None, z=0, visible=True):
+        super().__init__(x, y, z, visible)
+        self.path = path
+        self.frame = frame
+        self._update(path=path, pos=(x, y), frame=frame, z=z, visible=visible)
+
+    def set_image(self, path, frame=None):
+        "Change the image displayed by the sprite."
+        self.path, self.frame = path, frame
+        self._update(path=path, frame=frame)
+
+    def set_frame(self, frame):
+        "Change the frame of the sprite sheet displayed by the sprite."
+        self.frame = frame
+        self._update(frame=frame)
+
+class Text(_Persistent):
+    """
+    A text that stays on the window until it is destroyed, e.g. a score or a label.
+
+    Like `Sprite`, and unlike `draw_text`, it does not need to be drawn on each frame:
+    the window is only updated when it changes (e.g. calling `set_text` with the same
+    text does nothing). Texts are displayed on top of anything drawn with the `draw_*`
+    functions, and are stacked together with sprites according to `z`.
+
+    Args:
+        text: The text to display.
+        x: The screen coordinates for the text.
+        y: The screen coordinates for the text.
+        font: A `Font`, or a font family name (see `draw_text`).
+        size: Size of the text, if `font` is not a `Font`.
+        bold: Whether or not to use bold weight, if `font` is not a `Font`.
+        italic: Whether or not to use italic slant, if `font` is not a `Font`.
+        z: Stacking order, see `Sprite`.
+        visible: Whether the text is visible or not.
+        options: Extra options, such as `fill` and `anchor` (see `draw_text`).
+
+    The arguments are also available as (read-only) attributes (`font` is always a
+    `Font`).
+
+    Example:
+        ```
+        score = gamelib.Text('Score: 0', 10, 10, size=20, anchor='nw', fill='yellow')
+        while gamelib.loop(fps=30):
+            ...
+            score.set_text(f'Score: {points}')
+        ```
+    """
+
+    def __init__(self, text, x=0, y=0, font=None, size=12, bold=False, italic=False, z=0, visible=True, **options):
+        super().__init__(x, y, z, visible)
+        self.text = text
+        self.font = font if isinstance(font, Font) else Font(font, size, bold, italic)
+        self.options = options
+        self._update(text=text, pos=(x, y), font=self.font.key, options=options, z=z, visible=visible)
+
+    def set_text(self, text):
+        "Change the displayed text."
+        if text != self.text:
+            self.text = text
+            self._update(text=text)
+
+    def set_font(self, font):
+        "Change the font (a `Font`)."
+        if font is not self.font:
+            self.font = font
+            self._update(font=font.key)
+
+    def configure(self, **options):
+        "Change some of the extra options, e.g. `text.configure(fill='red')`."
+        options = {**self.options, **options}
+        if options != self.options:
+            self.options = options
+            self._update(options=options)
+
+class Font:
+    """
+    A font, that can be used in `draw_text` and `Text`, and can measure texts (e.g.
+    to center them, or to lay out a menu).
+
+    Fonts are cached: creating a `Font` twice with the same arguments returns the same
+    object, and the window creates the actual font only once. Measurements are also
+    cached, so measuring the same text again is cheap.
+
+    Args:
+        family: Font family name (see `draw_text`), or `None` for the default font.
+        size: Size of the text.
+        bold: Whether or not to use bold weight.
+        italic: Whether or not to use italic slant.
+
+    The arguments are also available as (read-only) attributes.
+
+    Example:
+        ```
+        font = gamelib.Font('Helvetica', 20, bold=True)
+        width = font.measure('Game over')
+        gamelib.draw_text('Game over', (W - width) / 2, 10, font=font, anchor='nw')
+        ```
+    """
+
+    _fonts = {}
+
+    # Maximum amount of cached measurements per font
+    MAX_MEASUREMENTS = 4096
+
+    def __new__(cls, family=None, size=12, bold=False, italic=False):
+        key = (family, size, bool(bold), bool(italic))
+        font = cls._fonts.get(key)
+        if font is None:
+            font = cls._fonts[key] = super().__new__(cls)
+            font.family, font.size, font.bold, font.italic = key
+            font.key = key
+            font._widths = {}
+            font._metrics = None
+        return font
+
+    def _query(self, method, *args):
+        response = Queue()
+        _GameThread.instance.send_command_to_tk(method, self.key, *args, response, notify=True)
+        return response.get()
+
+    def measure(self, text):
+        "Return the width of `text` in pixels, when drawn with this font."
+        width = self._widths.get(text)
+        if width is None:
+            if len(self._widths) >= self.MAX_MEASUREMENTS:
+                self._widths.clear()
+            width = self._widths[text] = self._query('measure_text', text)
+        return width
+
+    def metrics(self):
+        """
+        Return a dictionary with the metrics of the font, in pixels: `ascent` (the
+        distance between the baseline and the top of the highest character),
+        `descent` (the distance between the baseline and the bottom of the lowest
+        character), `linespace` (the distance between two lines of text) and `fixed`
+        (1 for monospaced fonts, 0 otherwise).
+        """
+        if self._metrics is None:
+            self._metrics = self._query('font_metrics')
+        return dict(self._metrics)
 
     def __repr__(self):
-        return repr(self.tkevent)
+        return f'<Font family={self.family!r} size={self.size} bold={self.bold} italic={self.italic}>'
+
+def _rgb(color):
+    "Convert a color in `'#rrggbb'` format to an `(r, g, b)` tuple"
+    if isinstance(color, str):
+        return int(color[1:3], 16), int(color[3:5], 16), int(color[5:7], 16)
+    return color
 
 if __name__ == '__main__':
     def interactive_main(_locals):
@@ -0,0 +1,258 @@
+"""
+Benchmark for the gamelib drawing pipeline.
+
+Runs a few scripted scenes of varying size and reports how many frames per second
+gamelib can sustain, the per-frame latency percentiles and the depth of the command
+queue between the game thread and the window.
+
+Usage:
+
+    $ python3 gamelib_bench.py                   # all scenes, in a window
+    $ python3 gamelib_bench.py --headless        # without a display
+    $ python3 gamelib_bench.py --json out.json   # also write machine-readable results
+    $ python3 gamelib_bench.py --scene bounce-1000 --frames 500
+"""
+
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+import gamelib
+
+SIZE = 600, 400
+
+class Bounce:
+    "N bouncing rectangles, like example-02-bounce.py"
+
+    def __init__(self, n):
+        W, H = SIZE
+        self.rects = [
+            [random.uniform(0, W), random.uniform(0, H), random.uniform(-5, 5), random.uniform(-5, 5)]
+            for _ in range(n)
+        ]
+
+    def draw(self, frame):
+        W, H = SIZE
+        for r in self.rects:
+            x, y, dx, dy = r
+            gamelib.draw_rectangle(x - 5, y - 5, x + 5, y + 5, fill='red')
+            x += dx
+            y += dy
+            if x > W or x < 0:
+                dx *= -1
+            if y > H or y < 0:
+                dy *= -1
+            r[:] = x, y, dx, dy
+
+class Life:
+    "A large grid of cells, like example-03-life.py"
+
+    def __init__(self, n):
+        self.n = n
+        self.cells = [[random.random() < 0.3 for _ in range(n)] for _ in range(n)]
+
+    def draw(self, frame):
+        W, H = SIZE
+        size = min(W, H) / self.n
+        for y, row in enumerate(self.cells):
+            for x, cell in enumerate(row):
+                if cell:
+                    gamelib.draw_rectangle(x * size, y * size, x * size + size, y * size + size, fill='white')
+        # flip a few cells so that the scene changes between frames
+        for _ in range(self.n):
+            row = random.choice(self.cells)
+            i = random.randrange(self.n)
+            row[i] = not row[i]
+
+class LifeBulk(Life):
+    "Same as Life, but drawn with a single draw_rectangles call"
+
+    def draw(self, frame):
+        W, H = SIZE
+        size = min(W, H) / self.n
+        coords = []
+        for y, row in enumerate(self.cells):
+            for x, cell in enumerate(row):
+                if cell:
+                    coords += (x * size, y * size, x * size + size, y * size + size)
+        gamelib.draw_rectangles(coords, fill='white')
+        for _ in range(self.n):
+            row = random.choice(self.cells)
+            i = random.randrange(self.n)
+            row[i] = not row[i]
+
+class Hud:
+    "A text-heavy HUD"
+
+    def __init__(self, n):
+        self.n = n
+
+    def draw(self, frame):
+        W, H = SIZE
+        cols = 6
+        for i in range(self.n):
+            x = (i % cols) * W / cols + 5
+            y = (i // cols) * 16 + 5
+            gamelib.draw_text(f'score {i}: {frame * (i + 1)}', x, y, size=9, anchor='nw')
+
+class Sprites:
+    "N images"
+
+    def __init__(self, n, path):
+        self.n = n
+        self.path = path
+
+    def draw(self, frame):
+        W, H = SIZE
+        for i in range(self.n):
+            x = (i * 37 + frame) % W
+            y = (i * 53 + frame) % H
+            gamelib.draw_image(self.path, x, y)
+
+class Tiles:
+    "A scrolling tile map much larger than the window"
+
+    def __init__(self, n, path):
+        self.tilemap = gamelib.TileMap(n, n, 8, 8, path)
+        for i, _ in enumerate(self.tilemap.tiles):
+            if random.random() < 0.5:
+                self.tilemap.tiles[i] = 0
+        self.tilemap.invalidate()
+
+    def draw(self, frame):
+        gamelib.draw_tilemap(self.tilemap, frame * 3, frame * 2)
+
+def make_image(directory):
+    "Create a small PPM image for the sprites scene"
+    path = os.path.join(directory, 'sprite.ppm')
+    w, h = 8, 8
+    with open(path, 'wb') as f:
+        f.write(f'P6 {w} {h} 255\n'.encode())
+        f.write(bytes([255, 200, 0]) * (w * h))
+    return path
+
+# scene name -> function that creates the scene, given the path of an image
+SCENES = {
+    'bounce-10': lambda image: Bounce(10),
+    'bounce-100': lambda image: Bounce(100),
+    'bounce-1000': lambda image: Bounce(1000),
+    'bounce-5000': lambda image: Bounce(5000),
+    'life-100': lambda image: Life(100),
+    'life-bulk-100': lambda image: LifeBulk(100),
+    'hud-200': lambda image: Hud(200),
+    'sprites-500': lambda image: Sprites(500, image),
+    'tiles-1000': lambda image: Tiles(1000, image),
+}
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run_scene(scene, frames):
+    "Draw `frames` frames as fast as possible, and return the measurements"
+    latencies = []
+    queue_depths = []
+    infos = []
+    gamelib.on_frame_stats(infos.append)
+    start = time.perf_counter()
+    for frame in range(frames):
+        if not gamelib.is_alive():
+            break
+        gamelib.get_events()
+        t = time.perf_counter()
+        gamelib.draw_begin()
+        scene.draw(frame)
+        gamelib.draw_end()
+        latencies.append(time.perf_counter() - t)
+        queue_depths.append(gamelib._Window.commands.qsize())
+    elapsed = time.perf_counter() - start
+    # let the window finish the last frame, so that its stats are reported
+    gamelib.draw_begin()
+    gamelib.draw_end()
+    gamelib.on_frame_stats(None)
+    render_times = [info['render_time'] for info in infos]
+    queue_waits = [info['queue_wait'] for info in infos]
+    n = len(latencies)
+    return {
+        'frames': n,
+        'seconds': elapsed,
+        'fps': n / elapsed if elapsed else 0.0,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p90': percentile(latencies, 0.90),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': max(latencies, default=0.0),
+        'render_p50': percentile(render_times, 0.50),
+        'render_p99': percentile(render_times, 0.99),
+        'queue_wait_p99': percentile(queue_waits, 0.99),
+        'queue_depth_avg': sum(queue_depths) / n if n else 0.0,
+        'queue_depth_max': max(queue_depths, default=0),
+        'dropped_frames': infos[-1]['dropped'] - infos[0]['dropped'] if infos else 0,
+    }
+
+def print_results(results):
+    print(
+        f"{'scene':<14} {'frames':>7} {'fps':>9} {'p50 ms':>8} {'p90 ms':>8} {'p99 ms':>8} {'max ms':>8}"
+        f" {'render ms':>10} {'queue':>6} {'dropped':>8}"
+    )
+    for name, r in results.items():
+        print(
+            f"{name:<14} {r['frames']:>7} {r['fps']:>9.1f}"
+            f" {r['latency_p50'] * 1000:>8.2f} {r['latency_p90'] * 1000:>8.2f}"
+            f" {r['latency_p99'] * 1000:>8.2f} {r['latency_max'] * 1000:>8.2f}"
+            f" {r['render_p50'] * 1000:>10.2f} {r['queue_depth_max']:>6} {r['dropped_frames']:>8}"
+        )
+
+def main(args):
+    random.seed(args.seed)
+    gamelib.title('gamelib benchmark')
+    gamelib.resize(*SIZE)
+    if args.pipeline:
+        gamelib.pipeline(args.pipeline)
+
+    with tempfile.TemporaryDirectory() as directory:
+        image = make_image(directory)
+        results = {}
+        for name in args.scene or SCENES:
+            if not gamelib.is_alive():
+                break
+            results[name] = run_scene(SCENES[name](image), args.frames)
+
+    print_results(results)
+    if args.json:
+        output = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'headless': args.headless,
+            'pipeline': args.pipeline,
+            'frames': args.frames,
+            'seed': args.seed,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'results': results,
+        }
+        if args.json == '-':
+            json.dump(output, sys.stdout, indent=2)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(output, f, indent=2)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the gamelib drawing pipeline.')
+    parser.add_argument('--scene', action='append', choices=SCENES, help='scene to run (may be repeated; default: all)')
+    parser.add_argument('--frames', type=int, default=200, help='frames per scene (default: 200)')
+    parser.add_argument('--pipeline', type=int, default=0, help='pipeline depth (default: 0, disabled)')
+    parser.add_argument('--headless', action='store_true', help='run without a window')
+    parser.add_argument('--seed', type=int, default=0, help='random seed (default: 0)')
+    parser.add_argument('--json', metavar='PATH', help="write results as JSON to PATH ('-' for stdout)")
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_args()
+    gamelib.init(main, args=[args], headless=args.headless or None)
@@ -0,0 +1,431 @@
+"""
+Collision detection for games with many objects.
+
+Checking every pair of objects for collisions takes time proportional to the square
+of the amount of objects. The indexes in this module keep track of where each object
+is, so that only objects that are close to each other are checked:
+
+* `SpatialHash` divides the plane in square cells of a fixed size. It is the best
+  choice when all the objects have similar sizes.
+* `QuadTree` divides a fixed area recursively. It works better when the objects have
+  very different sizes, or are concentrated in a few places.
+
+Both support axis-aligned boxes and circles, and have the same interface. Objects are
+identified by a key, which can be any hashable value (e.g. the object itself).
+
+Example:
+    ```
+    import gamelib
+    from gamelib_collision import SpatialHash
+
+    index = SpatialHash(cell_size=32)
+    for ball in balls:
+        index.add_circle(ball, ball.x, ball.y, ball.r)
+
+    while gamelib.loop(fps=30):
+        for ball in balls:
+            ball.move()
+            index.add_circle(ball, ball.x, ball.y, ball.r)
+        for a, b in index.pairs():
+            bounce(a, b)
+    ```
+
+`pairs()` uses NumPy when it is installed and there are many objects, but NumPy is
+not required.
+"""
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+BOX = 'box'
+CIRCLE = 'circle'
+
+def boxes_overlap(a, b):
+    "Return `True` if the boxes `a` and `b` (`(x1, y1, x2, y2)` tuples) overlap."
+    return a[0] < b[2] and b[0] < a[2] and a[1] < b[3] and b[1] < a[3]
+
+def circles_overlap(a, b):
+    "Return `True` if the circles `a` and `b` (`(x, y, radius)` tuples) overlap."
+    dx = a[0] - b[0]
+    dy = a[1] - b[1]
+    r = a[2] + b[2]
+    return dx * dx + dy * dy < r * r
+
+def box_circle_overlap(box, circle):
+    "Return `True` if `box` (`(x1, y1, x2, y2)`) and `circle` (`(x, y, radius)`) overlap."
+    x, y, r = circle
+    dx = x - min(max(x, box[0]), box[2])
+    dy = y - min(max(y, box[1]), box[3])
+    return dx * dx + dy * dy < r * r
+
+def _boxes_touch(a, b):
+    return a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]
+
+def shapes_overlap(kind_a, a, kind_b, b):
+    "Return `True` if the shapes overlap; `kind_a` and `kind_b` are `BOX` or `CIRCLE`."
+    if kind_a == BOX:
+        return boxes_overlap(a, b) if kind_b == BOX else box_circle_overlap(a, b)
+    return box_circle_overlap(b, a) if kind_b == BOX else circles_overlap(a, b)
+
+def sweep_pairs(boxes):
+    """
+    Return the list of `(i, j)` pairs of indices, with `i < j`, of the overlapping
+    boxes in the list `boxes` of `(x1, y1, x2, y2)` tuples (or in an N x 4 NumPy
+    array).
+
+    This uses the sort-and-sweep algorithm, vectorized with NumPy if it is installed.
+    """
+    if numpy is not None:
+        return _numpy_sweep_pairs(numpy.asarray(boxes, dtype=float).reshape(-1, 4))
+    order = sorted(range(len(boxes)), key=lambda i: boxes[i][0])
+    pairs = []
+    active = []
+    for i in order:
+        box = boxes[i]
+        active = [j for j in active if boxes[j][2] > box[0]]
+        for j in active:
+            other = boxes[j]
+            if box[1] < other[3] and other[1] < box[3]:
+                pairs.append((min(i, j), max(i, j)))
+        active.append(i)
+    return pairs
+
+def _numpy_sweep_pairs(boxes):
+    if not len(boxes):
+        return []
+    order = numpy.argsort(boxes[:, 0], kind='stable')
+    x1, y1, x2, y2 = boxes[order].T
+    # for each box, the boxes after it in x order that start before it ends
+    ends = numpy.searchsorted(x1, x2, side='left')
+    counts = ends - numpy.arange(1, len(x1) + 1)
+    counts = numpy.maximum(counts, 0)
+    first = numpy.repeat(numpy.arange(len(x1)), counts)
+    if not len(first):
+        return []
+    # index of each candidate: first + 1, first + 2, ...
+    offsets = numpy.arange(len(first)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+    second = first + 1 + offsets
+    hit = (y1[first] < y2[second]) & (y1[second] < y2[first])
+    a = order[first[hit]]
+    b = order[second[hit]]
+    return list(zip(numpy.minimum(a, b).tolist(), numpy.maximum(a, b).tolist()))
+
+class _Index:
+    "Common implementation of `SpatialHash` and `QuadTree`"
+
+    # Use NumPy in pairs() when there are at least this many objects
+    NUMPY_THRESHOLD = 500
+
+    def __init__(self):
+        # key -> (kind, shape, bounding box)
+        self.shapes = {}
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __contains__(self, key):
+        return key in self.shapes
+
+    def __iter__(self):
+        return iter(self.shapes)
+
+    def add_box(self, key, x1, y1, x2, y2):
+        """
+        Add an axis-aligned box to the index, or move it if `key` was already added.
+
+        Args:
+            key: Any hashable value identifying the object.
+            x1: The coordinates of a corner of the box.
+            y1: The coordinates of a corner of the box.
+            x2: The coordinates of the opposite corner of the box.
+            y2: The coordinates of the opposite corner of the box.
+        """
+        box = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        self._set(key, BOX, box, box)
+
+    def add_circle(self, key, x, y, radius):
+        """
+        Add a circle to the index, or move it if `key` was already added.
+
+        Args:
+            key: Any hashable value identifying the object.
+            x: The coordinates of the center.
+            y: The coordinates of the center.
+            radius: The radius.
+        """
+        self._set(key, CIRCLE, (x, y, radius), (x - radius, y - radius, x + radius, y + radius))
+
+    def _set(self, key, kind, shape, bbox):
+        old = self.shapes.get(key)
+        self.shapes[key] = (kind, shape, bbox)
+        if old is None:
+            self._insert(key, bbox)
+        elif old[2] != bbox:
+            self._move(key, old[2], bbox)
+
+    def remove(self, key):
+        "Remove an object from the index. Does nothing if it is not in the index."
+        old = self.shapes.pop(key, None)
+        if old is not None:
+            self._remove(key, old[2])
+
+    def clear(self):
+        "Remove all the objects."
+        for key in list(self.shapes):
+            self.remove(key)
+
+    def shape(self, key):
+        """
+        Return the shape of an object: `('box', (x1, y1, x2, y2))` or
+        `('circle', (x, y, radius))`.
+        """
+        kind, shape, bbox = self.shapes[key]
+        return kind, shape
+
+    def query_box(self, x1, y1, x2, y2):
+        "Return the set of keys of the objects that overlap the given box."
+        box = (min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2))
+        return self._query(BOX, box, box)
+
+    def query_circle(self, x, y, radius):
+        "Return the set of keys of the objects that overlap the given circle."
+        return self._query(CIRCLE, (x, y, radius), (x - radius, y - radius, x + radius, y + radius))
+
+    def query_point(self, x, y):
+        "Return the set of keys of the objects that contain the point `x, y`."
+        return {
+            key for key in self._candidates((x, y, x, y))
+            if self._contains_point(self.shapes[key], x, y)
+        }
+
+    def collisions(self, key):
+        "Return the set of keys of the objects that overlap the object `key`."
+        kind, shape, bbox = self.shapes[key]
+        return self._query(kind, shape, bbox) - {key}
+
+    def pairs(self):
+        """
+        Return a list with all the pairs of keys `(a, b)` of objects that overlap each
+        other. Each pair is included only once.
+        """
+        if numpy is not None and len(self.shapes) >= self.NUMPY_THRESHOLD:
+            keys = list(self.shapes)
+            boxes = [self.shapes[key][2] for key in keys]
+            candidates = ((keys[i], keys[j]) for i, j in sweep_pairs(boxes))
+        else:
+            candidates = self._candidate_pairs()
+        shapes = self.shapes
+        pairs = []
+        for a, b in candidates:
+            kind_a, shape_a, _ = shapes[a]
+            kind_b, shape_b, _ = shapes[b]
+            if shapes_overlap(kind_a, shape_a, kind_b, shape_b):
+                pairs.append((a, b))
+        return pairs
+
+    def _query(self, kind, shape, bbox):
+        shapes = self.shapes
+        result = set()
+        for key in self._candidates(bbox):
+            other_kind, other_shape, _ = shapes[key]
+            if shapes_overlap(kind, shape, other_kind, other_shape):
+                result.add(key)
+        return result
+
+    @staticmethod
+    def _contains_point(entry, x, y):
+        kind, shape, bbox = entry
+        if kind == BOX:
+            return shape[0] <= x <= shape[2] and shape[1] <= y <= shape[3]
+        dx = x - shape[0]
+        dy = y - shape[1]
+        return dx * dx + dy * dy <= shape[2] * shape[2]
+
+class SpatialHash(_Index):
+    """
+    A collision index that divides the plane in square cells of `cell_size` pixels.
+
+    Each object is registered in all the cells that its bounding box touches, so the
+    cell size should be about the size of the typical object (e.g. twice the radius of
+    the balls). There are no limits to the coordinates of the objects.
+
+    Args:
+        cell_size: The size of each cell, in pixels.
+    """
+
+    def __init__(self, cell_size=64):
+        super().__init__()
+        self.cell_size = cell_size
+        # (column, row) -> set of keys
+        self.cells = {}
+
+    def _cell_range(self, bbox):
+        size = self.cell_size
+        return (
+            int(bbox[0] // size), int(bbox[1] // size),
+            int(bbox[2] // size), int(bbox[3] // size),
+        )
+
+    def _cells(self, bbox):
+        c1, r1, c2, r2 = self._cell_range(bbox)
+        return [(c, r) for c in range(c1, c2 + 1) for r in range(r1, r2 + 1)]
+
+    def _insert(self, key, bbox):
+        cells = self.cells
+        for cell in self._cells(bbox):
+            if cell in cells:
+                cells[cell].add(key)
+            else:
+                cells[cell] = {key}
+
+    def _remove(self, key, bbox):
+        cells = self.cells
+        for cell in self._cells(bbox):
+            keys = cells[cell]
+            keys.discard(key)
+            if not keys:
+                del cells[cell]
+
+    def _move(self, key, old, new):
+        # most of the time the object stays in the same cells
+        if self._cell_range(old) != self._cell_range(new):
+            self._remove(key, old)
+            self._insert(key, new)
+
+    def _candidates(self, bbox):
+        cells = self.cells
+        candidates = set()
+        for cell in self._cells(bbox):
+            keys = cells.get(cell)
+            if keys:
+                candidates |= keys
+        return candidates
+
+    def _candidate_pairs(self):
+        seen = set()
+        for keys in self.cells.values():
+            if len(keys) < 2:
+                continue
+            keys = list(keys)
+            for i, a in enumerate(keys):
+                for b in keys[i + 1:]:
+                    if (a, b) not in seen and (b, a) not in seen:
+                        seen.add((a, b))
+                        yield a, b
+
+class _QuadNode:
+    def __init__(self, bounds, depth):
+        self.bounds = bounds
+        self.depth = depth
+        # key -> bounding box of the objects that are stored in this node
+        self.items = {}
+        self.children = None
+
+class QuadTree(_Index):
+    """
+    A collision index that divides the area `x1, y1, x2, y2` (e.g. the window or the
+    level) in four quadrants, and each quadrant in four more quadrants, and so on,
+    when there are more than `max_items` objects in them.
+
+    Objects outside of the area can also be added, but they are always checked
+    against every query.
+
+    Args:
+        x1: The coordinates of a corner of the area.
+        y1: The coordinates of a corner of the area.
+        x2: The coordinates of the opposite corner of the area.
+        y2: The coordinates of the opposite corner of the area.
+        max_items: Split a quadrant when it has more than this many objects.
+        max_depth: Maximum amount of times that the area is divided.
+    """
+
+    def __init__(self, x1, y1, x2, y2, max_items=8, max_depth=8):
+        super().__init__()
+        self.max_items = max_items
+        self.max_depth = max_depth
+        self.root = _QuadNode((min(x1, x2), min(y1, y2), max(x1, x2), max(y1, y2)), 0)
+        # key -> node where it is stored
+        self.nodes = {}
+
+    @staticmethod
+    def _fits(bounds, bbox):
+        return bounds[0] <= bbox[0] and bounds[1] <= bbox[1] and bbox[2] <= bounds[2] and bbox[3] <= bounds[3]
+
+    def _insert(self, key, bbox, node=None):
+        node = node or self.root
+        while node.children:
+            for child in node.children:
+                if self._fits(child.bounds, bbox):
+                    node = child
+                    break
+            else:
+                break
+        node.items[key] = bbox
+        self.nodes[key] = node
+        if not node.children and len(node.items) > self.max_items and node.depth < self.max_depth:
+            self._split(node)
+
+    def _split(self, node):
+        x1, y1, x2, y2 = node.bounds
+        mx, my = (x1 + x2) / 2, (y1 + y2) / 2
+        depth = node.depth + 1
+        node.children = [
+            _QuadNode((x1, y1, mx, my), depth),
+            _QuadNode((mx, y1, x2, my), depth),
+            _QuadNode((x1, my, mx, y2), depth),
+            _QuadNode((mx, my, x2, y2), depth),
+        ]
+        items = node.items
+        node.items = {}
+        for key, bbox in items.items():
+            self._insert(key, bbox, node)
+
+    def _remove(self, key, bbox):
+        node = self.nodes.pop(key)
+        del node.items[key]
+
+    def _move(self, key, old, new):
+        node = self.nodes[key]
+        # stay in the same node if the object still fits and cannot go deeper
+        if (node is self.root or self._fits(node.bounds, new)) and not (
+            node.children and any(self._fits(child.bounds, new) for child in node.children)
+        ):
+            node.items[key] = new
+            return
+        self._remove(key, old)
+        self._insert(key, new)
+
+    def _candidates(self, bbox):
+        candidates = set()
+        stack = [self.root]
+        while stack:
+            node = stack.pop()
+            for key, item in node.items.items():
+                if _boxes_touch(item, bbox):
+                    candidates.add(key)
+            if node.children:
+                for child in node.children:
+                    if _boxes_touch(child.bounds, bbox):
+                        stack.append(child)
+        return candidates
+
+    def _candidate_pairs(self):
+        # each object can only collide with objects in the same node, in the nodes
+        # above it, or in the nodes below it
+        stack = [(self.root, [])]
+        while stack:
+            node, above = stack.pop()
+            items = list(node.items.items())
+            for i, (a, box_a) in enumerate(items):
+                for b, box_b in items[i + 1:]:
+                    if _boxes_touch(box_a, box_b):
+                        yield a, b
+                for b, box_b in above:
+                    if _boxes_touch(box_a, box_b):
+                        yield b, a
+            if node.children:
+                above = above + items
+                for child in node.children:
+                    stack.append((child, above))
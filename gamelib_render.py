@@ -0,0 +1,434 @@
+"""
+Convert the frames saved with `gamelib.capture()` to a sequence of PPM or PNG images.
+
+The frames are rasterized in pure Python, which is slow but does not need a display
+or any library other than the Python standard library. The result is an
+approximation of what Tkinter displays: all shapes, framebuffers, tile maps, sprites and
+PPM/PGM images are drawn, but text and GIF images are not.
+
+Usage:
+
+    $ python3 gamelib_render.py capture.gz frames/                 # frames/00000.ppm, ...
+    $ python3 gamelib_render.py capture.gz frames/ --format png
+    $ python3 gamelib_render.py capture.gz frames/ --first 100 --last 200
+
+The PNG sequence can then be converted to a video, e.g. with ffmpeg:
+
+    $ ffmpeg -framerate 30 -i frames/%05d.png game.mp4
+"""
+
+import argparse
+import gzip
+import math
+import os
+import pickle
+import struct
+import sys
+import zlib
+
+import gamelib
+
+BACKGROUND = (0, 0, 0)
+DEFAULT_SIZE = gamelib._HeadlessWindow.DEFAULT_SIZE
+# Tk draws a black outline around rectangles and ovals unless told otherwise; the
+# fill color is always given (gamelib defaults to white)
+TK_OUTLINE = 'black'
+
+# A few of the color names supported by Tk; see parse_color
+COLORS = {
+    'black': (0, 0, 0),
+    'white': (255, 255, 255),
+    'red': (255, 0, 0),
+    'green': (0, 255, 0),
+    'blue': (0, 0, 255),
+    'yellow': (255, 255, 0),
+    'cyan': (0, 255, 255),
+    'magenta': (255, 0, 255),
+    'gray': (190, 190, 190),
+    'grey': (190, 190, 190),
+    'darkgray': (169, 169, 169),
+    'darkgrey': (169, 169, 169),
+    'lightgray': (211, 211, 211),
+    'lightgrey': (211, 211, 211),
+    'orange': (255, 165, 0),
+    'purple': (160, 32, 240),
+    'brown': (165, 42, 42),
+    'pink': (255, 192, 203),
+    'violet': (238, 130, 238),
+    'gold': (255, 215, 0),
+    'navy': (0, 0, 128),
+    'darkgreen': (0, 100, 0),
+    'darkblue': (0, 0, 139),
+    'darkred': (139, 0, 0),
+    'lightblue': (173, 216, 230),
+    'lightgreen': (144, 238, 144),
+}
+
+# Unknown colors that were already reported by parse_color
+_warned_colors = set()
+
+def parse_color(color):
+    "Convert a Tk color to an `(r, g, b)` tuple, or `None` if transparent"
+    if not color:
+        return None
+    if color.startswith('#'):
+        digits = (len(color) - 1) // 3
+        return tuple(
+            int(color[1 + i * digits:1 + (i + 1) * digits], 16) * 255 // (16 ** digits - 1)
+            for i in range(3)
+        )
+    name = color.replace(' ', '').lower()
+    if name in COLORS:
+        return COLORS[name]
+    if color not in _warned_colors:
+        _warned_colors.add(color)
+        print(f'Warning: unknown color {color!r}, using gray', file=sys.stderr)
+    return (128, 128, 128)
+
+def read_ppm(data):
+    "Parse a PPM/PGM image, and return `(width, height, rgb_pixels)`"
+    fields = []
+    pos = 0
+    while len(fields) < 4:
+        while data[pos:pos + 1].isspace():
+            pos += 1
+        if data[pos:pos + 1] == b'#':
+            pos = data.index(b'\n', pos)
+            continue
+        start = pos
+        while not data[pos:pos + 1].isspace():
+            pos += 1
+        fields.append(data[start:pos])
+    magic, width, height, maxval = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+    if magic in (b'P5', b'P6'):
+        n = width * height * (3 if magic == b'P6' else 1)
+        values = data[pos + 1:pos + 1 + n]
+    elif magic in (b'P2', b'P3'):
+        values = [int(v) for v in data[pos:].split()]
+    else:
+        raise ValueError(f'unsupported image format {magic!r}')
+    if maxval != 255:
+        values = [v * 255 // maxval for v in values]
+    if magic in (b'P2', b'P5'):
+        values = [v for v in values for _ in range(3)]
+    return width, height, bytearray(values)
+
+class Image:
+    def __init__(self, width, height, pixels=None, color=BACKGROUND):
+        self.width = width
+        self.height = height
+        self.pixels = pixels if pixels is not None else bytearray(color) * (width * height)
+
+    def crop(self, x, y, width, height):
+        pixels = bytearray()
+        for row in range(y, y + height):
+            start = (row * self.width + x) * 3
+            pixels += self.pixels[start:start + width * 3]
+        return Image(width, height, pixels)
+
+    def scale(self, zoom, subsample):
+        if zoom == subsample == 1:
+            return self
+        width = self.width * zoom // subsample
+        height = self.height * zoom // subsample
+        pixels = bytearray()
+        for y in range(height):
+            row = y * subsample // zoom * self.width
+            for x in range(width):
+                i = (row + x * subsample // zoom) * 3
+                pixels += self.pixels[i:i + 3]
+        return Image(width, height, pixels)
+
+class Canvas(Image):
+    "A very small subset of the Tk canvas"
+
+    def hline(self, y, x1, x2, color):
+        "Paint the pixels between x1 and x2 (inclusive) in row y"
+        if not 0 <= y < self.height:
+            return
+        x1 = max(0, int(math.ceil(x1)))
+        x2 = min(self.width - 1, int(math.floor(x2)))
+        if x2 < x1:
+            return
+        start = (int(y) * self.width + x1) * 3
+        self.pixels[start:start + (x2 - x1 + 1) * 3] = bytes(color) * (x2 - x1 + 1)
+
+    def fill_rect(self, x1, y1, x2, y2, color):
+        for y in range(max(0, int(math.ceil(y1))), min(self.height, int(math.floor(y2)) + 1)):
+            self.hline(y, x1, x2, color)
+
+    def fill_polygon(self, points, color):
+        "Fill a polygon with the even-odd rule"
+        ys = points[1::2]
+        edges = list(zip(
+            zip(points[0::2], points[1::2]),
+            zip(points[2::2] + points[:1], points[3::2] + points[1:2]),
+        ))
+        for y in range(max(0, int(math.ceil(min(ys)))), min(self.height, int(math.floor(max(ys))) + 1)):
+            yc = y + 0.5
+            xs = sorted(
+                x1 + (yc - y1) * (x2 - x1) / (y2 - y1)
+                for (x1, y1), (x2, y2) in edges
+                if (y1 <= yc < y2) or (y2 <= yc < y1)
+            )
+            for i in range(0, len(xs) - 1, 2):
+                self.hline(y, xs[i], xs[i + 1] - 1, color)
+
+    def line(self, x1, y1, x2, y2, width, color):
+        "Draw a line as a polygon `width` pixels wide"
+        length = math.hypot(x2 - x1, y2 - y1)
+        if not length:
+            self.fill_rect(x1 - width / 2, y1 - width / 2, x1 + width / 2, y1 + width / 2, color)
+            return
+        dx = (y2 - y1) / length * max(width, 1) / 2
+        dy = (x1 - x2) / length * max(width, 1) / 2
+        self.fill_polygon([x1 + dx, y1 + dy, x2 + dx, y2 + dy, x2 - dx, y2 - dy, x1 - dx, y1 - dy], color)
+
+    def outline(self, points, width, color, closed=True):
+        if closed:
+            points = points + points[:2]
+        for i in range(0, len(points) - 2, 2):
+            self.line(*points[i:i + 4], width, color)
+
+    def oval(self, x1, y1, x2, y2, fill, outline, width, start=None, extent=None):
+        """
+        Draw an oval, or a pie slice of it if `start` and `extent` (in degrees,
+        counterclockwise) are given
+        """
+        cx, cy = (x1 + x2) / 2, (y1 + y2) / 2
+        rx, ry = abs(x2 - x1) / 2, abs(y2 - y1) / 2
+        if not rx or not ry:
+            return
+        border = width if outline else 0
+        for y in range(max(0, int(y1)), min(self.height, int(math.ceil(y2)) + 1)):
+            dy = (y + 0.5 - cy) / ry
+            if abs(dy) > 1:
+                continue
+            half = rx * math.sqrt(1 - dy * dy)
+            if start is None:
+                inner = max(0.0, half - border)
+                if fill:
+                    self.hline(y, cx - inner, cx + inner - 1, fill)
+                if outline:
+                    self.hline(y, cx - half, cx - inner - 1, outline)
+                    self.hline(y, cx + inner, cx + half - 1, outline)
+                continue
+            for x in range(max(0, int(cx - half)), min(self.width, int(math.ceil(cx + half)))):
+                angle = math.degrees(math.atan2(cy - y - 0.5, x + 0.5 - cx))
+                if (angle - start) % 360 > extent % 360 and extent < 360:
+                    continue
+                dx = (x + 0.5 - cx) / rx
+                edge = math.sqrt(dx * dx + dy * dy) > 1 - border / min(rx, ry)
+                color = outline if edge else fill
+                if color:
+                    self.hline(y, x, x, color)
+
+    def blit(self, image, x, y):
+        x, y = int(x), int(y)
+        x1, x2 = max(0, x), min(self.width, x + image.width)
+        if x2 <= x1:
+            return
+        for row in range(max(0, y), min(self.height, y + image.height)):
+            src = ((row - y) * image.width + x1 - x) * 3
+            dst = (row * self.width + x1) * 3
+            self.pixels[dst:dst + (x2 - x1) * 3] = image.pixels[src:src + (x2 - x1) * 3]
+
+    def ppm(self):
+        return f'P6 {self.width} {self.height} 255\n'.encode() + bytes(self.pixels)
+
+    def png(self):
+        def chunk(tag, data):
+            return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data))
+        stride = self.width * 3
+        raw = b''.join(
+            b'\0' + bytes(self.pixels[y * stride:(y + 1) * stride]) for y in range(self.height)
+        )
+        return (
+            b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw))
+            + chunk(b'IEND', b'')
+        )
+
+class Renderer:
+    "Keeps the state needed to rasterize the frames of a capture file"
+
+    def __init__(self):
+        self.framebuffers = {}
+        self.tile_chunks = {}
+        self.sheets = {}
+        self.images = {}
+        self.skipped = set()
+
+    def update_framebuffer(self, id, width, height, x, y, data):
+        fb = self.framebuffers.get(id)
+        if fb is None or (fb.width, fb.height) != (width, height):
+            fb = self.framebuffers[id] = Image(width, height)
+        w, h, pixels = read_ppm(data)
+        region = Image(w, h, pixels)
+        Canvas.blit(fb, region, x, y)
+
+    def update_tile_chunk(self, id, chunk, atlas, tile_size, size, tiles):
+        self.tile_chunks[(id, chunk)] = (atlas, tile_size, size, tiles)
+
+    def tile(self, atlas, tile_size, tile):
+        key = ('tile', atlas, tile_size, tile)
+        if key not in self.images:
+            sheet = self.image(atlas)
+            image = None
+            if sheet:
+                w, h = tile_size
+                columns = sheet.width // w
+                image = sheet.crop(tile % columns * w, tile // columns * h, w, h)
+            self.images[key] = image
+        return self.images[key]
+
+    def image(self, path, frame=None, zoom=1, subsample=1):
+        key = (path, frame, zoom, subsample)
+        if key not in self.images:
+            image = None
+            try:
+                with open(path, 'rb') as f:
+                    image = Image(*read_ppm(f.read()))
+                if frame is not None:
+                    w, h = self.sheets[path]
+                    columns = image.width // w
+                    image = image.crop(frame % columns * w, frame // columns * h, w, h)
+                image = image.scale(zoom, subsample)
+            except (OSError, ValueError, KeyError) as e:
+                self.skip(f'image {path}: {e}')
+            self.images[key] = image
+        return self.images[key]
+
+    def skip(self, what):
+        if what not in self.skipped:
+            self.skipped.add(what)
+            print(f'Warning: not rendering {what}', file=sys.stderr)
+
+    def render(self, size, items, sprites):
+        canvas = Canvas(*(size or DEFAULT_SIZE))
+        for type, coords, options in items:
+            self.draw(canvas, type, list(coords), options)
+        for sprite in sprites:
+            if 'text' in sprite:
+                self.skip('text')
+                continue
+            image = self.image(sprite['path'], sprite['frame'])
+            if image:
+                canvas.blit(image, *sprite['pos'])
+        return canvas
+
+    def draw(self, canvas, type, coords, options):
+        width = float(options.get('width', 1))
+        if type == 'rectangle':
+            x1, y1, x2, y2 = coords
+            x1, x2 = sorted((x1, x2))
+            y1, y2 = sorted((y1, y2))
+            fill = parse_color(options['fill'])
+            outline = parse_color(options.get('outline', TK_OUTLINE))
+            if fill:
+                canvas.fill_rect(x1, y1, x2 - 1, y2 - 1, fill)
+            if outline and width:
+                canvas.outline([x1, y1, x2, y1, x2, y2, x1, y2], width, outline)
+        elif type == 'oval':
+            canvas.oval(
+                *coords,
+                parse_color(options['fill']),
+                parse_color(options.get('outline', TK_OUTLINE)),
+                width,
+            )
+        elif type == 'arc':
+            style = options.get('style', 'pieslice')
+            canvas.oval(
+                *coords,
+                parse_color(options['fill']) if style != 'arc' else None,
+                parse_color(options.get('outline', TK_OUTLINE)),
+                width,
+                float(options.get('start', 0)),
+                float(options.get('extent', 90)),
+            )
+        elif type == 'line':
+            color = parse_color(options['fill'])
+            if color:
+                canvas.outline(coords, width, color, closed=False)
+        elif type == 'polygon':
+            fill = parse_color(options['fill'])
+            outline = parse_color(options.get('outline'))
+            if fill:
+                canvas.fill_polygon(coords, fill)
+            if outline and width:
+                canvas.outline(coords, width, outline)
+        elif type == 'image':
+            image = self.image(
+                options['image'], options['frame'], options['zoom'], options['subsample'],
+            )
+            if image:
+                canvas.blit(image, *coords)
+        elif type == 'framebuffer':
+            fb = self.framebuffers.get(options['framebuffer'])
+            if fb:
+                canvas.blit(fb, *coords)
+        elif type == 'tilechunk':
+            # tiles are drawn one by one, so that empty tiles are transparent
+            atlas, (w, h), (columns, rows), tiles = self.tile_chunks[options['tilemap'], options['chunk']]
+            x, y = coords
+            for i, tile in enumerate(tiles):
+                image = self.tile(atlas, (w, h), tile) if tile >= 0 else None
+                if image:
+                    canvas.blit(image, x + i % columns * w, y + i // columns * h)
+        else:
+            self.skip(type)
+
+def read_capture(path):
+    "Generate the records of a file written by `gamelib.capture()`"
+    with gzip.open(path, 'rb') as f:
+        header = pickle.load(f)
+        if header != ('gamelib-capture', gamelib._FrameCapture.VERSION):
+            raise ValueError(f'{path} is not a gamelib capture file')
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                # end of file, or truncated file if the game was killed
+                return
+
+def main():
+    args = parse_args()
+    os.makedirs(args.output, exist_ok=True)
+    renderer = Renderer()
+    count = 0
+    for record in read_capture(args.capture):
+        kind, *data = record
+        if kind == 'framebuffer':
+            renderer.update_framebuffer(*data)
+        elif kind == 'tile_chunk':
+            renderer.update_tile_chunk(*data)
+        elif kind == 'drop_tile_chunks':
+            id, chunks = data
+            for chunk in chunks:
+                renderer.tile_chunks.pop((id, chunk), None)
+        elif kind == 'sprite_sheet':
+            path, w, h = data
+            renderer.sheets[path] = (w, h)
+        elif kind == 'frame':
+            index, size, items, sprites = data
+            if index < args.first or (args.last is not None and index > args.last):
+                continue
+            canvas = renderer.render(size, items, sprites)
+            output = os.path.join(args.output, f'{index:05d}.{args.format}')
+            with open(output, 'wb') as f:
+                f.write(canvas.png() if args.format == 'png' else canvas.ppm())
+            count += 1
+    print(f'{count} frames written to {args.output}')
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Convert the frames saved with gamelib.capture() to images.')
+    parser.add_argument('capture', help='file written by gamelib.capture()')
+    parser.add_argument('output', help='output directory')
+    parser.add_argument('--format', choices=('ppm', 'png'), default='ppm', help='image format (default: ppm)')
+    parser.add_argument('--first', type=int, default=0, help='first frame to convert')
+    parser.add_argument('--last', type=int, help='last frame to convert')
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    main()